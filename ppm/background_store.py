@@ -0,0 +1,106 @@
+""" Functions to write and read the remapped background store. The mapped peptides and details
+    of every peptide length and dataset are held as remapped/{len}/{dataset}/peptides.parquet
+    and details/{name}.parquet, with the space separated protein and splicing columns of the
+    remapping output stored as native list columns.
+"""
+import os
+
+import polars as pl
+
+from ppm.constants import SPLICE_SPECIFIC_FEATURES
+
+INT_LIST_COLUMNS = ['interveningSeqLengths', 'sr1_Index', 'sr2_Index', 'isForward']
+
+
+def convert_background_store(config):
+    """ Function to convert the remapped background CSVs written by earlier versions into the
+        parquet store. The CSVs are kept, datasets already in the store are skipped.
+    """
+    remapped_folder = f'{config.background_folder}/remapped'
+    for pep_len in sorted(os.listdir(remapped_folder)):
+        for dataset in sorted(os.listdir(f'{remapped_folder}/{pep_len}')):
+            dataset_folder = f'{remapped_folder}/{pep_len}/{dataset}'
+            if (
+                not os.path.exists(f'{dataset_folder}/peptides.csv') or
+                os.path.exists(f'{dataset_folder}/peptides.parquet')
+            ):
+                continue
+            print(f'Converting {dataset}, length {pep_len}...')
+            for file_name in sorted(os.listdir(f'{dataset_folder}/details')):
+                if file_name.endswith('.csv'):
+                    write_background_file(
+                        read_background_csv(f'{dataset_folder}/details/{file_name}'),
+                        f'{dataset_folder}/details/{file_name[:-4]}.parquet',
+                    )
+            # The mapped peptides are written last as they mark a converted dataset.
+            write_background_file(
+                read_background_csv(f'{dataset_folder}/peptides.csv'),
+                f'{dataset_folder}/peptides.parquet',
+            )
+
+
+def read_background_csv(csv_path):
+    """ Function to read a CSV written by the remapping, inferring types from all rows.
+    """
+    return pl.read_csv(csv_path, infer_schema_length=None)
+
+
+def write_background_file(frame, parquet_path):
+    """ Function to write mapped peptides or details to the store, one row per peptide and
+        with list columns.
+    """
+    pep_df = split_background_lists(frame.lazy()).unique(
+        'peptide', keep='first', maintain_order=True,
+    ).collect()
+    pep_df.write_parquet(f'{parquet_path}.tmp')
+    os.replace(f'{parquet_path}.tmp', parquet_path)
+
+
+def split_background_lists(frame):
+    """ Function to convert the space separated columns of a DataFrame or LazyFrame of
+        mapped peptides or details into list columns, dropping empty entries. Columns which
+        are already lists are left unchanged, single entry columns read as numbers are split
+        as strings.
+    """
+    expressions = []
+    for column, dtype in frame.collect_schema().items():
+        if isinstance(dtype, pl.List) or not is_list_column(column):
+            continue
+        list_expr = pl.col(column).cast(pl.String).str.split(' ').list.eval(
+            pl.element().filter(pl.element().str.len_chars() > 0)
+        )
+        if column in INT_LIST_COLUMNS:
+            list_expr = list_expr.cast(pl.List(pl.Int64))
+        expressions.append(list_expr.alias(column))
+    return frame.with_columns(expressions)
+
+
+def is_list_column(column):
+    """ Function to check if a column of the remapping output holds space separated lists.
+    """
+    return (
+        column in SPLICE_SPECIFIC_FEATURES or column == 'splicedProteins' or
+        column.endswith('_Proteins')
+    )
+
+
+def get_background_path(dataset_folder, name):
+    """ Function to get the path of mapped peptides (name peptides) or details (name
+        details/{stratum}) of a dataset, preferring the parquet store over CSVs of earlier
+        versions. Returns None if neither exists.
+    """
+    for extension in ('parquet', 'csv'):
+        if os.path.exists(f'{dataset_folder}/{name}.{extension}'):
+            return f'{dataset_folder}/{name}.{extension}'
+    return None
+
+
+def scan_background(dataset_folder, name):
+    """ Function to get a LazyFrame of mapped peptides or details of a dataset, one row per
+        peptide and with list columns. Filters and column selections on the parquet store
+        are pushed down into the scan, CSVs of earlier versions are read and deduplicated.
+    """
+    background_path = get_background_path(dataset_folder, name)
+    if background_path.endswith('.parquet'):
+        return pl.scan_parquet(background_path)
+    return split_background_lists(pl.read_csv(background_path).unique('peptide').lazy())
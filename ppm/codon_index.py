@@ -0,0 +1,107 @@
+""" Functions to build and load a per ORF index of start and stop codon positions, so that the
+    upstream codon scan for every peptide hit becomes a constant time lookup.
+"""
+import os
+
+import numpy as np
+import polars as pl
+
+from ppm.constants import START_CODONS, STOP_CODONS
+from ppm.kozak_scoring import kozak_similarity_scores
+
+CODON_INDEX_COLUMNS = (
+    ['prevStop'] + [f'prev_{start_codon}' for start_codon in START_CODONS] + ['kozakScores']
+)
+CODON_INDEX_SCHEMA = {
+    'prevStop': pl.Int32,
+    **{f'prev_{start_codon}': pl.Int32 for start_codon in START_CODONS},
+    'kozakScores': pl.Float64,
+}
+
+
+def get_codon_index(config, stratum):
+    """ Function to load the codon index for the ORFs of a stratum, building it and persisting
+        it next to the antigen parquet if it does not exist or is older than the parquet.
+    """
+    antigen_path = f'{config.antigen_folder}/{stratum}.parquet'
+    index_path = f'{config.antigen_folder}/{stratum}_codonIndex.parquet'
+    if (
+        os.path.exists(index_path) and
+        os.path.getmtime(index_path) >= os.path.getmtime(antigen_path)
+    ):
+        return pl.read_parquet(index_path)
+
+    index_df = build_codon_index(pl.read_parquet(antigen_path, columns=['proteinID', 'rnaSeq']))
+    try:
+        # Temporary files are named per process, as parallel jobs may write the same index.
+        index_df.write_parquet(f'{index_path}.{os.getpid()}.tmp')
+        os.replace(f'{index_path}.{os.getpid()}.tmp', index_path)
+    except OSError:
+        print(f'Could not write codon index to {index_path}, continuing without persisting.')
+    return index_df
+
+
+def build_codon_index(prot_df):
+    """ Function to build the codon index of every ORF in a DataFrame with proteinID and
+        rnaSeq columns. Each index column holds one entry per codon of the ORF.
+    """
+    indices = [index_codons(rna_seq) for rna_seq in prot_df['rnaSeq'].to_list()]
+    n_codons = [len(codon_index['prevStop']) for codon_index in indices]
+    flat_df = pl.DataFrame(
+        {
+            'proteinID': np.repeat(prot_df['proteinID'].to_numpy(), n_codons),
+            **{
+                column: (
+                    np.concatenate([codon_index[column] for codon_index in indices])
+                    if indices else []
+                ) for column in CODON_INDEX_COLUMNS
+            },
+        },
+        schema={'proteinID': pl.String, **CODON_INDEX_SCHEMA},
+    )
+    index_df = flat_df.group_by('proteinID', maintain_order=True).agg(CODON_INDEX_COLUMNS)
+
+    # ORFs shorter than a codon keep an entry with empty index lists.
+    return prot_df.select('proteinID').unique(maintain_order=True).join(
+        index_df, on='proteinID', how='left',
+    ).with_columns(
+        pl.col(column).fill_null(pl.lit([], dtype=pl.List(dtype)))
+        for column, dtype in CODON_INDEX_SCHEMA.items()
+    )
+
+
+def index_codons(rna_seq):
+    """ Function to index the codons of a single ORF. For every codon position the index gives
+        the nearest stop codon and the nearest occurrence of each start codon at or before that
+        position (-1 if there is none), and the Kozak score of the AUG at that position (NaN if
+        the position is not an AUG with enough flanking sequence).
+    """
+    n_codons = len(rna_seq)//3
+    codons = np.frombuffer(rna_seq[:n_codons*3].encode('ascii'), dtype='S3')
+    codon_idx = np.arange(n_codons, dtype=np.int32)
+
+    codon_index = {
+        'prevStop': _previous_match(
+            np.isin(codons, [stop_codon.encode() for stop_codon in STOP_CODONS]), codon_idx,
+        ),
+    }
+    for start_codon in START_CODONS:
+        codon_index[f'prev_{start_codon}'] = _previous_match(
+            codons == start_codon.encode(), codon_idx,
+        )
+
+    kozak_scores = np.full(n_codons, np.nan, dtype=np.float64)
+    aug_idxs = np.flatnonzero(codons == b'AUG')
+    aug_idxs = aug_idxs[(aug_idxs*3 > 10) & (aug_idxs*3 + 13 < len(rna_seq))].tolist()
+    if aug_idxs:
+        kozak_scores[aug_idxs] = kozak_similarity_scores(
+            [rna_seq[(aug_idx*3)-10:(aug_idx*3)+13] for aug_idx in aug_idxs]
+        )
+    codon_index['kozakScores'] = kozak_scores
+    return codon_index
+
+
+def _previous_match(is_match, codon_idx):
+    """ Helper function to get the last matching index at or before each index.
+    """
+    return np.maximum.accumulate(np.where(is_match, codon_idx, -1)).astype(np.int32)
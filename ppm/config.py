@@ -27,6 +27,8 @@ class Config:
         self.output_folder = self.output_folder.replace('~', home).replace('%USERPROFILE%', home)
         if self.output_folder.endswith('/'):
             self.output_folder = self.output_folder[:-1]
+        if self.db_shard_folder is None:
+            self.db_shard_folder = f'{self.output_folder}/piscesDbShards'
 
         if not os.path.exists(self.output_folder):
             os.makedirs(self.output_folder)
@@ -62,4 +64,19 @@ class Config:
         self.proteome = config_dict.get('proteome')
         self.cryptic_folder = config_dict.get('crypticFolder')
         self.canonical_results = config_dict.get('canonicalResults')
+        self.incremental_db = config_dict.get('incrementalDb', False)
+        self.db_shard_folder = config_dict.get('dbShardFolder')
+        self.legacy_combine = config_dict.get('legacyCombine', False)
+        self.streaming_db = config_dict.get('streamingDb', False)
+        self.db_partitions = config_dict.get('dbPartitions', 16)
+        self.n_random_peptides = config_dict.get('nRandomPeptides', 1_000_000)
+        self.adaptive_background = config_dict.get('adaptiveBackground', False)
+        self.remap_shard_size = config_dict.get('remapShardSize', 100_000)
+        self.shared_remapping = config_dict.get('sharedRemapping', False)
+        self.protein_feature_cache = config_dict.get('proteinFeatureCache', False)
+        self.single_pass_preprocess = config_dict.get('singlePassPreprocess', False)
+        self.parallel_preprocess = config_dict.get('parallelPreprocess', False)
+        self.background_cache = config_dict.get('backgroundCache', False)
+        self.spliced_chunk_work = config_dict.get('splicedChunkWork', 5_000_000)
+        self.validate_spliced_background = config_dict.get('validateSplicedBackground', False)
 
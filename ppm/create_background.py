@@ -1,8 +1,12 @@
 
+import hashlib
+from math import ceil
+import multiprocessing as mp
 import os
+import shutil
+import zlib
 
 import numpy as np
-from numpy.random import choice
 import polars as pl
 import pandas as pd
 
@@ -11,11 +15,16 @@ from pisces.remap import (
     process_fasta_folder, extract_spliced_details, extract_details
 )
 
-np.random.seed(42)
+from ppm.background_store import get_background_path, read_background_csv, write_background_file
 
-N_RANDOM_PEPTIDES = 1_000_000
+RANDOM_SEED = 42
+ADAPTIVE_BACKGROUND_MARGIN = 1.05
 
 AMINO_ACIDS = 'ACDEFGHKLMNPQRSTVWY' # Isoleucine ignored for PISCES applications.
+AMINO_ACID_CODES = np.full(256, len(AMINO_ACIDS), dtype=np.uint8)
+AMINO_ACID_CODES[np.frombuffer(AMINO_ACIDS.encode('ascii'), dtype=np.uint8)] = np.arange(
+    len(AMINO_ACIDS), dtype=np.uint8
+)
 
 def create_bg(config, pep_length):
     get_can_distro(config, pep_length)
@@ -27,33 +36,38 @@ def get_can_distro(config, pep_length):
     if not os.path.exists(f'{config.background_folder}/frequency_dfs/{pep_length}'):
         os.mkdir(f'{config.background_folder}/frequency_dfs/{pep_length}')
 
-    can_df_counts = []
-    pep_df = pl.read_parquet('/data/John/ALL_FINAL/shared_dfs/casanovo_241124/peptides.parquet')
-    datasets = pep_df['datasets'].explode().unique(maintain_order=True).sort().to_list()
+    # Single pass over the peptides parquet for all datasets of the cell line.
+    can_df = pl.scan_parquet(config.peptides_pq).filter(
+        pl.col('stratum').eq('canonical') & pl.col('piscesDiscoverable') &
+        pl.col('peptide').str.len_chars().eq(pep_length) &
+        pl.col('cellLines').list.contains(config.cell_line)
+    ).select(['peptide', 'datasets']).explode('datasets')
     if config.cell_line == 'K562':
-        datasets = [x for x in datasets if x.startswith('K562')]
+        can_df = can_df.filter(pl.col('datasets').str.starts_with('K562'))
     else:
-        datasets = [x for x in datasets if not x.startswith('K562')]
-
-    for dataset in datasets:
-        remapped_df = pep_df.filter(pl.col('datasets').list.contains(dataset))
-        can_df = remapped_df.filter(
-            pl.col('stratum').eq('canonical') & pl.col('piscesDiscoverable') &
-            pl.col('peptide').str.len_chars().eq(pep_length) &
-            pl.col('cellLines').list.contains(config.cell_line)
-        )
-        if not can_df.shape[0]:
-            continue
+        can_df = can_df.filter(~pl.col('datasets').str.starts_with('K562'))
+    can_df = can_df.unique().sort(['datasets', 'peptide']).collect()
+
+    datasets = can_df['datasets'].unique(maintain_order=True).to_list()
+    dataset_idx = np.searchsorted(np.array(datasets), can_df['datasets'].to_numpy())
+    dataset_sizes = np.bincount(dataset_idx, minlength=len(datasets))
 
+    # Count amino acids at each position for all datasets at once.
+    pep_codes = encode_peptides(can_df['peptide'].to_list(), pep_length)
+    flat_idx = (
+        (dataset_idx[:, None]*len(AMINO_ACIDS) + pep_codes)*pep_length +
+        np.arange(pep_length)[None, :]
+    )
+    all_counts = np.bincount(
+        flat_idx.ravel(), minlength=len(datasets)*len(AMINO_ACIDS)*pep_length,
+    ).reshape(len(datasets), len(AMINO_ACIDS), pep_length)
+
+    can_df_counts = []
+    for ds_idx, dataset in enumerate(datasets):
         can_df_counts.append(
-            {'dataset': dataset, 'count': can_df['peptide'].n_unique()}
-        ) 
-        counts = np.zeros(shape=(len(AMINO_ACIDS), pep_length))
-        for peptide in can_df['peptide'].to_list():
-            for pos_idx, a_a in enumerate(peptide):
-                aa_idx = AMINO_ACIDS.index(a_a)
-                counts[aa_idx, pos_idx] += 1
-        counts /= can_df.shape[0]
+            {'dataset': dataset, 'count': dataset_sizes[ds_idx]}
+        )
+        counts = all_counts[ds_idx]/dataset_sizes[ds_idx]
 
         df = pd.DataFrame(
             counts, index=list(AMINO_ACIDS), columns=list(range(1,pep_length+1))
@@ -70,80 +84,317 @@ def get_can_distro(config, pep_length):
     )
 
 
+def encode_peptides(peptides, pep_length):
+    """ Function to encode peptides of equal length as a matrix of amino acid indices.
+    """
+    pep_bytes = np.frombuffer(''.join(peptides).encode('ascii'), dtype=np.uint8)
+    pep_codes = AMINO_ACID_CODES[pep_bytes].reshape(-1, pep_length)
+    if (pep_codes == len(AMINO_ACIDS)).any():
+        raise ValueError('Peptides contain residues outside of the background amino acids.')
+    return pep_codes.astype(np.int64)
+
+
 def generate_random(config, pep_length):
     if not os.path.exists(f'{config.background_folder}/random_dfs/{pep_length}'):
         os.mkdir(f'{config.background_folder}/random_dfs/{pep_length}')
 
-    for file_name in os.listdir(f'{config.background_folder}/frequency_dfs/{pep_length}'):
-        freq_df = pd.read_csv(
-            f'{config.background_folder}/frequency_dfs/{pep_length}/{file_name}'
-        )
-        groups = [
-            choice(
-                list(AMINO_ACIDS), N_RANDOM_PEPTIDES, p=freq_df[str(pos_idx)]
-            ) for pos_idx in range(1,pep_length+1)
-        ]
-        peptides = []
-        for row_idx in range(N_RANDOM_PEPTIDES):
-            peptides.append(''.join(
-                groups[pos_idx][row_idx] for pos_idx in range(pep_length)
-            ))
-
-        random_df = pd.DataFrame({'peptide': peptides})
-        random_df.to_csv(
-            f'{config.background_folder}/random_dfs/{pep_length}/{file_name}', index=False,
+    n_random_peptides = get_n_random_peptides(config, pep_length)
+    func_args = []
+    for file_name in sorted(os.listdir(f'{config.background_folder}/frequency_dfs/{pep_length}')):
+        dataset = file_name.split('.')[0]
+        func_args.append((
+            f'{config.background_folder}/frequency_dfs/{pep_length}/{file_name}',
+            f'{config.background_folder}/random_dfs/{pep_length}/{dataset}.parquet',
+            pep_length,
+            n_random_peptides[dataset],
+            [RANDOM_SEED, pep_length, zlib.crc32(dataset.encode())],
+        ))
+
+    if config.n_cores > 1 and len(func_args) > 1:
+        with mp.get_context('spawn').Pool(processes=min(config.n_cores, len(func_args))) as pool:
+            pool.starmap(generate_random_peptides, func_args)
+    else:
+        for args in func_args:
+            generate_random_peptides(*args)
+
+
+def get_n_random_peptides(config, pep_length):
+    """ Function to get the number of random peptides to generate for each dataset. In
+        adaptive mode this is scaled by the dataset sampling ratio, as negative sampling
+        never draws more than the dataset fraction of the largest background.
+    """
+    if isinstance(config.n_random_peptides, dict):
+        max_n_peptides = config.n_random_peptides[pep_length]
+    else:
+        max_n_peptides = config.n_random_peptides
+
+    sample_df = pd.read_csv(f'{config.background_folder}/sample_ratios/ratio_{pep_length}.csv')
+    n_random_peptides = {}
+    for dataset, fraction in zip(sample_df['dataset'], sample_df['fraction']):
+        if config.adaptive_background:
+            n_random_peptides[dataset] = min(
+                ceil(max_n_peptides*fraction*ADAPTIVE_BACKGROUND_MARGIN), max_n_peptides
+            )
+        else:
+            n_random_peptides[dataset] = max_n_peptides
+    return n_random_peptides
+
+
+def generate_random_peptides(freq_path, output_path, pep_length, n_peptides, seed):
+    """ Function to sample random peptides from the amino acid frequencies at each
+        position and write them to parquet.
+    """
+    freq_df = pd.read_csv(freq_path)
+    rng = np.random.default_rng(seed)
+
+    # Sample amino acid indices for every position by inverting the cumulative frequencies.
+    pep_codes = np.empty((n_peptides, pep_length), dtype=np.uint8)
+    for pos_idx in range(pep_length):
+        cum_freqs = np.cumsum(freq_df[str(pos_idx+1)].to_numpy())
+        pep_codes[:, pos_idx] = np.minimum(
+            np.searchsorted(cum_freqs/cum_freqs[-1], rng.random(n_peptides), side='right'),
+            len(AMINO_ACIDS) - 1,
         )
 
-CANONICAL_PROTEOME = 'background_analsis/proteome_CDS_main_ORF.fasta'
-EXPANDED_STRATA_FOLDER = 'dataFolder/allStrata'
-N_CORES = 70
+    # Decode all peptides at once by viewing each row of ASCII codes as a single string.
+    pep_bytes = np.frombuffer(AMINO_ACIDS.encode('ascii'), dtype=np.uint8)[pep_codes]
+    peptides = pep_bytes.view(f'S{pep_length}').ravel().astype(f'U{pep_length}')
+
+    pl.DataFrame({'peptide': peptides}).write_parquet(output_path)
+
 
 def remap_random(config, pep_length):
-    """ Function to remap peptides to the spliced proteome.
+    """ Function to remap peptides to the spliced proteome, writing the mapped peptides and
+        details of each dataset to the parquet background store.
     """
     if not os.path.exists(f'{config.background_folder}/remapped/{pep_length}'):
         os.mkdir(f'{config.background_folder}/remapped/{pep_length}')
 
-    for file_name in os.listdir(
+    all_random_files = {}
+    random_files = {}
+    for file_name in sorted(os.listdir(
         f'{config.background_folder}/random_dfs/{pep_length}'
-        ):
+        )):
         dataset = file_name.split('.')[0]
-        if os.path.exists(f'{config.background_folder}/remapped/{pep_length}/{dataset}/peptides.csv'):
+        all_random_files[dataset] = (
+            f'{config.background_folder}/random_dfs/{pep_length}/{file_name}'
+        )
+        if get_background_path(
+            f'{config.background_folder}/remapped/{pep_length}/{dataset}', 'peptides'
+        ) is not None:
             print(f'Skipping {dataset}...')
             continue
-        else:
-            print(f'Running {dataset}...')
+        random_files[dataset] = all_random_files[dataset]
 
-        unique_pep_df = pl.read_csv(
-            f'{config.background_folder}/random_dfs/{pep_length}/{file_name}'
-        )
-        unique_pep_df = unique_pep_df.unique()
+    if config.shared_remapping:
+        shared_folder = get_shared_folder(config, pep_length, all_random_files)
+        # An interrupted shared remapping is resumed even if only one dataset is left.
+        if len(random_files) > 1 or (random_files and os.path.exists(shared_folder)):
+            remap_shared(config, pep_length, random_files, all_random_files, shared_folder)
+            return
+
+    for dataset, random_file in random_files.items():
+        print(f'Running {dataset}...')
+        unique_pep_df = read_random_peptides(random_file).unique().sort('peptide')
         output_folder = f'{config.background_folder}/remapped/{pep_length}/{dataset}'
-        if not os.path.exists(output_folder):
-            os.mkdir(output_folder)
-        if not os.path.exists(f'{output_folder}/details'):
-            os.mkdir(f'{output_folder}/details')
-
-        # Map to canonical and spliced strata.
-        unique_pep_df = distribute_mapping(
-            unique_pep_df,
-            config.proteome,
-            'canonical',
-            config.n_cores,
-            with_splicing=True,
-            max_intervening=None,
+        remap_sharded(unique_pep_df, config, output_folder)
+
+
+def get_shared_folder(config, pep_length, all_random_files):
+    """ Function to get the folder of the shared remapping of a peptide length, keyed by all
+        of its datasets and the content of their random peptides so that it is found again
+        when an interrupted run resumes, even after the random peptides are regenerated.
+        Shared folders with other keys are removed.
+    """
+    datasets_hash = hashlib.md5()
+    for dataset, random_file in all_random_files.items():
+        datasets_hash.update(
+            f'{dataset}:{get_peptides_hash(read_random_peptides(random_file))}|'.encode()
         )
+    remapped_folder = f'{config.background_folder}/remapped/{pep_length}'
+    shared_folder = f'{remapped_folder}/_shared_{datasets_hash.hexdigest()[:12]}'
 
-        # Extract details for canonical and spliced
-        unique_pep_df = extract_details(unique_pep_df, [], output_folder, 'canonical')
-        unique_pep_df = extract_spliced_details(unique_pep_df, output_folder)
-
-        # Map to cryptic strata and extract details
-        unique_pep_df, _ = process_fasta_folder(
-            unique_pep_df,
-            config.cryptic_folder,
-            config.n_cores,
-            output_folder,
-            'cryptic',
+    for folder_name in os.listdir(remapped_folder):
+        if folder_name.startswith('_shared_') and folder_name != os.path.basename(shared_folder):
+            print(f'Removing stale shared remapping {folder_name}...')
+            shutil.rmtree(f'{remapped_folder}/{folder_name}')
+    return shared_folder
+
+
+def remap_shared(config, pep_length, random_files, all_random_files, shared_folder):
+    """ Function to remap the union of random peptides across datasets once and project
+        the mapping back onto the outputs of every dataset. The datasets of the union are
+        recorded in the shared folder, so a rerun resumes the remapping and only projects
+        the datasets which are not yet written.
+    """
+    manifest_path = f'{shared_folder}/datasets.csv'
+    if os.path.exists(manifest_path) and not set(random_files).issubset(
+        pl.read_csv(manifest_path)['dataset'].to_list()
+    ):
+        shutil.rmtree(shared_folder)
+    if not os.path.exists(manifest_path):
+        os.makedirs(shared_folder, exist_ok=True)
+        pl.DataFrame({'dataset': list(random_files)}).write_csv(f'{manifest_path}.tmp')
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+    shared_datasets = pl.read_csv(manifest_path)['dataset'].to_list()
+
+    if not os.path.exists(f'{shared_folder}/peptides.parquet'):
+        unique_pep_df = pl.concat([
+            read_random_peptides(all_random_files[dataset]).unique()
+            for dataset in shared_datasets
+        ]).unique().sort('peptide')
+        print(
+            f'Running {len(shared_datasets)} datasets via {unique_pep_df.shape[0]} '
+            'shared peptides...'
         )
-        unique_pep_df.write_csv(f'{output_folder}/peptides.csv')
+        remap_sharded(unique_pep_df, config, shared_folder)
+
+    for dataset, random_file in random_files.items():
+        print(f'Projecting {dataset}...')
+        project_remapped(
+            read_random_peptides(random_file).unique(),
+            shared_folder,
+            f'{config.background_folder}/remapped/{pep_length}/{dataset}',
+        )
+    shutil.rmtree(shared_folder)
+
+
+def project_remapped(dataset_pep_df, shared_folder, output_folder):
+    """ Function to write the details and mapped peptides of the shared remapping which
+        belong to a single dataset.
+    """
+    if not os.path.exists(f'{output_folder}/details'):
+        os.makedirs(f'{output_folder}/details')
+
+    for file_name in os.listdir(f'{shared_folder}/details'):
+        write_background_file(
+            pl.scan_parquet(f'{shared_folder}/details/{file_name}').join(
+                dataset_pep_df.lazy(), how='semi', on='peptide',
+            ),
+            f'{output_folder}/details/{file_name}',
+        )
+
+    write_background_file(
+        pl.scan_parquet(f'{shared_folder}/peptides.parquet').join(
+            dataset_pep_df.lazy(), how='semi', on='peptide',
+        ),
+        f'{output_folder}/peptides.parquet',
+    )
+
+
+def read_random_peptides(random_file):
+    """ Function to read random peptides written as parquet or, by earlier versions, as CSV.
+    """
+    if random_file.endswith('.parquet'):
+        return pl.read_parquet(random_file)
+    return pl.read_csv(random_file)
+
+
+def get_peptides_hash(pep_df):
+    """ Function to hash the peptide column of a DataFrame, in order, so that checkpoints are
+        keyed by the peptides rather than by file modification times.
+    """
+    return hashlib.md5('\n'.join(pep_df['peptide'].to_list()).encode()).hexdigest()[:12]
+
+
+def remap_sharded(unique_pep_df, config, output_folder):
+    """ Function to remap peptides in fixed size shards, checkpointing the mapping and
+        details of every shard so that an interrupted run resumes from the last
+        completed shard. The shards are kept in a folder keyed by the shard size and the
+        peptides, shards left by a run with other peptides or another size are removed.
+    """
+    shards_root = (
+        f'{output_folder}/shards_{config.remap_shard_size}_{get_peptides_hash(unique_pep_df)}'
+    )
+    if os.path.exists(output_folder):
+        for stale_shards in os.listdir(output_folder):
+            if (
+                (stale_shards == 'shards' or stale_shards.startswith('shards_')) and
+                f'{output_folder}/{stale_shards}' != shards_root
+            ):
+                shutil.rmtree(f'{output_folder}/{stale_shards}')
+
+    n_shards = max(ceil(unique_pep_df.shape[0]/config.remap_shard_size), 1)
+    shard_folders = []
+    for shard_idx in range(n_shards):
+        shard_folder = f'{shards_root}/{shard_idx}'
+        shard_folders.append(shard_folder)
+        if os.path.exists(f'{shard_folder}/peptides.csv'):
+            print(f'\tSkipping completed shard {shard_idx+1} of {n_shards}...')
+            continue
+        print(f'\tRunning shard {shard_idx+1} of {n_shards}...')
+        remap_peptides(
+            unique_pep_df.slice(shard_idx*config.remap_shard_size, config.remap_shard_size),
+            config,
+            shard_folder,
+        )
+
+    merge_remapped_shards(shard_folders, output_folder)
+    shutil.rmtree(shards_root)
+
+
+def remap_peptides(unique_pep_df, config, output_folder):
+    """ Function to map peptides to the canonical, spliced and cryptic strata, writing
+        details to the output folder and the mapped peptides last.
+    """
+    if not os.path.exists(f'{output_folder}/details'):
+        os.makedirs(f'{output_folder}/details')
+
+    # Map to canonical and spliced strata.
+    unique_pep_df = distribute_mapping(
+        unique_pep_df,
+        config.proteome,
+        'canonical',
+        config.n_cores,
+        with_splicing=True,
+        max_intervening=None,
+    )
+
+    # Extract details for canonical and spliced
+    unique_pep_df = extract_details(unique_pep_df, [], output_folder, 'canonical')
+    unique_pep_df = extract_spliced_details(unique_pep_df, output_folder)
+
+    # Map to cryptic strata and extract details
+    unique_pep_df, _ = process_fasta_folder(
+        unique_pep_df,
+        config.cryptic_folder,
+        config.n_cores,
+        output_folder,
+        'cryptic',
+    )
+    unique_pep_df.write_csv(f'{output_folder}/peptides.csv')
+
+
+def merge_remapped_shards(shard_folders, output_folder):
+    """ Function to merge the details and mapped peptides of all shards into the parquet
+        background store, writing the mapped peptides last as they mark a completed remapping.
+    """
+    if not os.path.exists(f'{output_folder}/details'):
+        os.makedirs(f'{output_folder}/details')
+
+    details_files = sorted({
+        file_name for shard_folder in shard_folders
+        for file_name in os.listdir(f'{shard_folder}/details')
+    })
+    for file_name in details_files:
+        write_background_file(
+            _concat_csvs([
+                f'{shard_folder}/details/{file_name}' for shard_folder in shard_folders
+                if os.path.exists(f'{shard_folder}/details/{file_name}')
+            ]),
+            f'{output_folder}/details/{os.path.splitext(file_name)[0]}.parquet',
+        )
+
+    write_background_file(
+        _concat_csvs([f'{shard_folder}/peptides.csv' for shard_folder in shard_folders]),
+        f'{output_folder}/peptides.parquet',
+    )
+
+
+def _concat_csvs(csv_files):
+    """ Helper function to concatenate CSV files, columns with different types between
+        files are cast to a common type.
+    """
+    return pl.concat(
+        [read_background_csv(csv_file) for csv_file in csv_files], how='diagonal_relaxed',
+    )
@@ -1,6 +1,11 @@
 """ Functions for combining PISCES and t/d dataframes from multiple projects
     into a single dataframe.
 """
+import hashlib
+import multiprocessing as mp
+import os
+import shutil
+
 import polars as pl
 import pandas as pd
 from pisces.plot_utils import split_strata, split_nc_strata
@@ -42,6 +47,26 @@ COUNT_COLUMNS = {
 INT_COLS = [
     'interveningSeqLengths', 'sr1_Index', 'sr2_Index', 'isForward',
 ]
+ALL_DFS_ORDER = [
+    'contaminant', 'canonical (pisces)',
+    'spliced', 'multi-mapped', 'cryptic', 'unmapped',
+    'canonical (t/d)', 'contam (t/d)',
+]
+COMBINED_COLUMNS = [
+    'peptide', 'stratum', 'piscesDiscoverable', 'tdDiscoverable',
+    'datasets', 'cellLines', 'alleles', 'maxProbability',
+] + COLUMNS + ['nDatasets']
+SHARD_FILE_NAMES = {
+    'contaminant': 'contaminant', 'canonical (pisces)': 'canonicalPisces',
+    'spliced': 'spliced', 'multi-mapped': 'multiMapped', 'cryptic': 'cryptic',
+    'unmapped': 'unmapped', 'canonical (t/d)': 'canonicalTD', 'contam (t/d)': 'contamTD',
+}
+PROJECT_INPUT_FILES = [
+    'filtered_mapped.csv', 'canonicalOutput/finalPsmAssignments.csv',
+    'details/canonical.csv', 'details/spliced.csv', 'details/cryptic.csv',
+]
+DB_SORT_COLUMNS = ['stratum', 'maxProbability', 'peptide']
+DB_SORT_DESCENDING = [False, True, False]
 SPLICED_FEATS = [
     'sr1','interveningSeqLengths','splicedProteins','sr1_Index','sr2_Index','isForward'
 ]
@@ -49,40 +74,265 @@ SPLICED_FEATS = [
 def create_pisces_db(config):
     """ Function to create a PISCES database from multiple projects.
     """
-    all_dfs = {
-        'contaminant': [], 'canonical (pisces)': [],
-        'spliced': [], 'multi-mapped': [], 'cryptic': [], 'unmapped': [],
-        'canonical (t/d)': [], 'contam (t/d)': [],
-    }
+    if config.streaming_db and config.legacy_combine:
+        raise ValueError('legacyCombine cannot be used with streamingDb.')
+
     meta_df = pd.read_csv(config.meta_df)
-    for _, df_row in meta_df.iterrows():
-        project_path = df_row['projectPath']
-        dataset = df_row['dataset']
-        allele = df_row['allele']
-        cell_line = df_row['cellLine']
-
-        remapped_df, td_df = get_identified_peptides(project_path)
-
-        can_td_df = td_df[~td_df['mapsToContaminant']]
-        contam_td_df = td_df[td_df['mapsToContaminant']]
-        can_df, contam_df, nc_df = split_strata(remapped_df)
-        spliced_df, mm_df, cryptic_df, unmapped_df = split_nc_strata(nc_df)
-
-        for strat_df, name in zip(
-            [
-                can_td_df, contam_td_df, can_df, contam_df,
-                spliced_df, mm_df, cryptic_df, unmapped_df
-            ],
-            ALL_NAMES,
-        ):
-            id_df, details_df = get_details_df(
-                strat_df, name, project_path
+    if config.incremental_db or config.streaming_db:
+        shard_paths = ingest_projects_to_shards(config, meta_df)
+        if config.streaming_db:
+            create_partitioned_db(config, shard_paths)
+            return
+        if config.legacy_combine:
+            all_dfs = read_project_shards(shard_paths)
+        else:
+            stratum_lfs = scan_project_shards(shard_paths)
+    else:
+        all_dfs = ingest_projects(config, meta_df)
+        if not config.legacy_combine:
+            stratum_lfs = get_stratum_lazy_frames(all_dfs)
+
+    if config.legacy_combine:
+        combined_df = combine_all_strata(all_dfs)
+        combined_lf = pl.from_pandas(resolve_duplicates(combined_df)).lazy()
+    else:
+        combined_lf = resolve_duplicates_lazy(combine_all_strata_lazy(stratum_lfs))
+
+    finalise_database(combined_lf).sort(
+        by=DB_SORT_COLUMNS, descending=DB_SORT_DESCENDING,
+    ).collect().write_parquet(config.peptides_pq)
+
+def finalise_database(combined_lf):
+    """ Function to convert the list columns and count the proteins of the combined
+        identifications.
+    """
+    combined_lf = combined_lf.with_columns(split_list_columns())
+    return combined_lf.with_columns(
+        pl.col(list_column).list.len().alias(count_column)
+        for count_column, list_column in COUNT_COLUMNS.items()
+    )
+
+def create_partitioned_db(config, shard_paths):
+    """ Function to build the database from project shards one peptide hash partition at a
+        time. All identifications of a peptide fall into the same partition, so each
+        partition is combined and deduplicated on its own. The rows are then split into
+        ranges of the final sort order, with boundaries taken from the first partition,
+        and each range is sorted on its own so that no step holds the whole cohort.
+    """
+    partition_folder = partition_project_shards(config, shard_paths)
+    range_boundaries = None
+    for partition in range(config.db_partitions):
+        print(f'Combining partition {partition + 1} of {config.db_partitions}...')
+        stratum_lfs = {
+            name: pl.scan_parquet([
+                f'{partition_folder}/{partition}/{SHARD_FILE_NAMES[name]}_{shard_idx}.parquet'
+                for shard_idx in range(len(shard_paths))
+            ]) for name in ALL_DFS_ORDER
+        }
+        partition_df = finalise_database(
+            resolve_duplicates_lazy(combine_all_strata_lazy(stratum_lfs))
+        ).collect()
+        shutil.rmtree(f'{partition_folder}/{partition}')
+
+        if range_boundaries is None:
+            range_boundaries = get_range_boundaries(partition_df, config.db_partitions)
+        partition_df = partition_df.with_columns(get_sort_range(range_boundaries))
+        for sort_range in range(len(range_boundaries) + 1):
+            os.makedirs(f'{partition_folder}/ranges/{sort_range}', exist_ok=True)
+            partition_df.filter(pl.col('sortRange').eq(sort_range)).drop('sortRange').write_parquet(
+                f'{partition_folder}/ranges/{sort_range}/{partition}.parquet'
             )
-            id_df = combine_dfs(id_df, details_df, allele, cell_line, dataset, name)
-            all_dfs[name].append(id_df)
 
-    combined_df = combine_all_strata(all_dfs)
+    range_paths = []
+    for sort_range in range(len(range_boundaries) + 1):
+        range_paths.append(f'{partition_folder}/ranges/{sort_range}.parquet')
+        pl.scan_parquet(f'{partition_folder}/ranges/{sort_range}/*.parquet').sort(
+            by=DB_SORT_COLUMNS, descending=DB_SORT_DESCENDING,
+        ).sink_parquet(range_paths[-1])
+    pl.scan_parquet(range_paths).sink_parquet(config.peptides_pq)
+    shutil.rmtree(partition_folder)
+
+def get_range_boundaries(partition_df, n_ranges):
+    """ Function to get the sort columns of evenly spaced rows of a partition in the final
+        sort order. Peptides are hashed to partitions, so the rows of one partition sample
+        the sort order of the whole database.
+    """
+    sorted_df = partition_df.select(DB_SORT_COLUMNS).sort(
+        by=DB_SORT_COLUMNS, descending=DB_SORT_DESCENDING,
+    )
+    return sorted_df[
+        [sorted_df.shape[0]*idx//n_ranges for idx in range(1, n_ranges)]
+    ].unique(maintain_order=True).rows() if sorted_df.shape[0] else []
+
+def get_sort_range(range_boundaries):
+    """ Function to get the expression counting the range boundaries that each row sorts
+        at or after, missing probabilities sort first as in the final sort.
+    """
+    max_probability = pl.col('maxProbability').fill_null(float('inf'))
+    after_boundary = [
+        pl.col('stratum').gt(stratum) | (
+            pl.col('stratum').eq(stratum) & (
+                max_probability.lt(float('inf') if probability is None else probability) | (
+                    max_probability.eq(float('inf') if probability is None else probability) &
+                    pl.col('peptide').ge(peptide)
+                )
+            )
+        ) for stratum, probability, peptide in range_boundaries
+    ]
+    return pl.sum_horizontal(
+        [pl.lit(0, dtype=pl.UInt32)] + [is_after.cast(pl.UInt32) for is_after in after_boundary]
+    ).alias('sortRange')
+
+def partition_project_shards(config, shard_paths):
+    """ Function to split the stratum shards of every project by peptide hash, reading one
+        shard at a time. Rows keep their order, so each partition is combined as it would
+        be within the whole cohort.
+    """
+    partition_folder = f'{config.db_shard_folder}/partitions'
+    if os.path.exists(partition_folder):
+        shutil.rmtree(partition_folder)
+    for partition in range(config.db_partitions):
+        os.makedirs(f'{partition_folder}/{partition}')
+
+    for shard_idx, shard_path in enumerate(shard_paths):
+        for name in ALL_DFS_ORDER:
+            shard_df = pl.read_parquet(
+                f'{shard_path}/{SHARD_FILE_NAMES[name]}.parquet'
+            ).with_columns(
+                (pl.col('peptide').hash(seed=0) % config.db_partitions).alias('partition')
+            )
+            # Empty partitions are written too, so that every scan has the shard schema.
+            for partition in range(config.db_partitions):
+                shard_df.filter(pl.col('partition').eq(partition)).drop('partition').write_parquet(
+                    f'{partition_folder}/{partition}/{SHARD_FILE_NAMES[name]}_{shard_idx}.parquet'
+                )
+    return partition_folder
+
+def split_list_columns():
+    """ Function to get the expressions converting the space separated string columns
+        into list columns.
+    """
+    expressions = []
+    for column in COLUMNS:
+        if 'nProteins' in column or column in ['nCrypticProteins', 'nSplicedProteins']:
+            continue
+        list_expr = pl.col(column).cast(pl.String).fill_null('').str.split(' ').list.eval(
+            pl.element().filter(pl.element().str.len_chars() > 0)
+        )
+        if column in INT_COLS:
+            list_expr = list_expr.cast(pl.List(pl.Int64))
+        expressions.append(list_expr.alias(column))
+    return expressions
+
+def combine_all_strata_lazy(stratum_lfs):
+    """ Function to combine all strata into a single LazyFrame, equivalent to
+        combine_all_strata.
+    """
+    stratum_lfs = {
+        stratum_name: combine_stratum_lazy(stratum_name, stratum_lfs[stratum_name])
+        for stratum_name in ALL_DFS_ORDER
+    }
+
+    combo_lf = pl.concat(
+        [stratum_lfs[stratum_name] for stratum_name in NC_NAMES], how='vertical_relaxed',
+    )
+    combo_lf = combo_lf.unique(subset=['peptide'], keep='first', maintain_order=True)
 
+    contam_lf = combine_td_pisces_lazy(
+        [stratum_lfs['contaminant'], stratum_lfs['contam (t/d)']]
+    )
+    can_lf = combine_td_pisces_lazy(
+        [stratum_lfs['canonical (pisces)'], stratum_lfs['canonical (t/d)']]
+    )
+    return pl.concat(
+        [contam_lf, can_lf, combo_lf.select(COMBINED_COLUMNS)], how='vertical_relaxed',
+    )
+
+
+def combine_stratum_lazy(stratum_name, combo_lf):
+    """ Function to combine identifications of a given stratum across projects,
+        equivalent to combine_stratum_dfs.
+    """
+    if 'canonical' in stratum_name:
+        stratum = 'canonical'
+    elif stratum_name == 'contam (t/d)':
+        stratum = 'contaminant'
+    else:
+        stratum = stratum_name
+
+    combo_lf = combo_lf.group_by('peptide', maintain_order=True).agg(
+        pl.col('adjustedProbability').max().alias('maxProbability'),
+        *[pl.col(column).unique().sort() for column in ['datasets', 'cellLines', 'alleles']],
+        *[pl.col(column).drop_nulls().first() for column in COLUMNS],
+    )
+    return combo_lf.with_columns(
+        pl.lit(stratum).alias('stratum'),
+        pl.lit('t/d' not in stratum_name).alias('piscesDiscoverable'),
+        pl.lit('t/d' in stratum_name).alias('tdDiscoverable'),
+        pl.col('datasets').list.len().cast(pl.Int64).alias('nDatasets'),
+    ).sort('maxProbability', descending=True, maintain_order=True)
+
+
+def combine_td_pisces_lazy(lfs):
+    """ Function to combine t/d and PISCES LazyFrames, equivalent to combine_td_pisces_dfs.
+    """
+    combo_lf = pl.concat(lfs, how='vertical_relaxed')
+    combo_lf = combo_lf.group_by('peptide', maintain_order=True).agg(
+        pl.col('stratum').drop_nulls().first(),
+        pl.col('piscesDiscoverable').max(),
+        pl.col('tdDiscoverable').max(),
+        *[
+            pl.col(column).flatten().unique().sort()
+            for column in ['datasets', 'cellLines', 'alleles']
+        ],
+        pl.col('maxProbability').max(),
+        *[pl.col(column).drop_nulls().first() for column in COLUMNS],
+    )
+    combo_lf = combo_lf.with_columns(
+        pl.col('datasets').list.len().cast(pl.Int64).alias('nDatasets'),
+    )
+    return combo_lf.sort('maxProbability', descending=True, maintain_order=True).select(
+        COMBINED_COLUMNS
+    )
+
+
+def resolve_duplicates_lazy(combined_lf):
+    """ Function to merge peptides identified in several strata, equivalent to
+        resolve_duplicates.
+    """
+    combined_lf = combined_lf.with_columns(pl.len().over('peptide').alias('nEntries'))
+    unique_lf = combined_lf.filter(pl.col('nEntries').eq(1)).drop('nEntries')
+    duplicated_lf = combined_lf.filter(pl.col('nEntries').gt(1))
+
+    duplicated_lf = duplicated_lf.group_by('peptide', maintain_order=True).agg(
+        pl.when(pl.col('stratum').eq('contaminant').any()).then(
+            pl.lit('contaminant')
+        ).otherwise(pl.lit('error')).alias('stratum'),
+        pl.col('piscesDiscoverable').max(),
+        pl.col('tdDiscoverable').max(),
+        *[
+            pl.col(column).flatten().unique().sort()
+            for column in ['datasets', 'cellLines', 'alleles']
+        ],
+        pl.col('maxProbability').max(),
+    )
+    duplicated_lf = duplicated_lf.with_columns(
+        pl.col('datasets').list.len().cast(pl.Int64).alias('nDatasets'),
+        *[
+            pl.lit(0, dtype=pl.Int64).alias(column)
+            if 'nProteins' in column or column in ['nCrypticProteins', 'nSplicedProteins']
+            else pl.lit('').alias(column)
+            for column in COLUMNS
+        ],
+    )
+    return pl.concat(
+        [unique_lf, duplicated_lf.select(COMBINED_COLUMNS)], how='vertical_relaxed',
+    )
+
+
+def resolve_duplicates(combined_df):
+    """ Function to merge peptides identified in several strata.
+    """
     unique_df = combined_df.drop_duplicates(subset=['peptide'], keep=False)
     duplicated_df = combined_df[combined_df.duplicated(subset=['peptide'], keep=False)]
 
@@ -102,39 +352,8 @@ def create_pisces_db(config):
         else:
             duplicated_df[column] = ''
 
-    combined_df = pd.concat([unique_df, duplicated_df[unique_df.columns]])
-
-    combined_df = pl.from_pandas(combined_df)
-    for column in COLUMNS:
-        if not 'nProteins' in column and column not in ['nCrypticProteins', 'nSplicedProteins']:
-            if column in INT_COLS:
-                combined_df = combined_df.with_columns(
-                    pl.col(column).map_elements(
-                        lambda x : [] if (not x or x is None) else [int(a) for a in x.split(' ')],
-                        return_dtype=pl.List(pl.Int64)
-                    )
-                )
-                combined_df = combined_df.with_columns(
-                    pl.col(column).fill_null([])
-                )
-            else:
-                combined_df = combined_df.with_columns(
-                    pl.col(column).map_elements(
-                        lambda x : [] if (not x or x is None) else [y for y in x.split(' ') if y and y is not None],
-                        return_dtype=pl.List(pl.String)
-                    )
-                )
-                combined_df = combined_df.with_columns(
-                    pl.col(column).fill_null([])
-                )
-
-    for count_column, list_columns in COUNT_COLUMNS.items():
-        combined_df = combined_df.with_columns(
-            pl.col(list_columns).list.len().alias(count_column)
-        )
+    return pd.concat([unique_df, duplicated_df[unique_df.columns]])
 
-    combined_df = combined_df.sort(by=['stratum', 'maxProbability'], descending=[False, True])
-    combined_df.write_parquet(config.peptides_pq)
 
 def combine_all_strata(all_dfs):
     """ Function to combine all strata into a single dataframe.
@@ -144,9 +363,9 @@ def combine_all_strata(all_dfs):
     contam_dfs = []
     agg_dict = {
             'adjustedProbability': 'max',
-            'datasets': lambda x : list(set(x)),
-            'alleles': lambda x : list(set(x)),
-            'cellLines': lambda x : list(set(x)),
+            'datasets': lambda x : sorted(set(x)),
+            'alleles': lambda x : sorted(set(x)),
+            'cellLines': lambda x : sorted(set(x)),
         }
     agg_dict.update({col: 'first' for col in COLUMNS})
 
@@ -167,6 +386,150 @@ def combine_all_strata(all_dfs):
     total_df = pd.concat([contam_df, can_df, combo_df])
     return total_df
 
+def ingest_projects(config, meta_df):
+    """ Function to ingest all projects of the metaDf in memory.
+    """
+    all_dfs = {name: [] for name in ALL_DFS_ORDER}
+    func_args = [
+        (df_row['projectPath'], df_row['dataset'], df_row['allele'], df_row['cellLine'])
+        for _, df_row in meta_df.iterrows()
+    ]
+    for strat_dfs in _run_ingestion(ingest_project, func_args, config.n_cores):
+        for name, id_df in strat_dfs.items():
+            all_dfs[name].append(id_df)
+
+    return all_dfs
+
+
+def ingest_projects_to_shards(config, meta_df):
+    """ Function to ingest the projects of the metaDf into per project folders of
+        stratum parquet shards. In incremental mode only projects which are new or
+        whose input files have changed are re-ingested.
+        Returns the paths to the shards of all projects.
+    """
+    if not os.path.exists(config.db_shard_folder):
+        os.makedirs(config.db_shard_folder)
+
+    shard_paths = []
+    func_args = []
+    for _, df_row in meta_df.iterrows():
+        project_hash = get_project_hash(
+            df_row['projectPath'], df_row['dataset'], df_row['allele'], df_row['cellLine']
+        )
+        shard_path = f'{config.db_shard_folder}/{df_row["dataset"]}_{project_hash}'
+        shard_paths.append(shard_path)
+        if config.incremental_db and os.path.exists(shard_path):
+            print(f'Reusing shard for {df_row["dataset"]}...')
+            continue
+
+        for stale_shard in os.listdir(config.db_shard_folder):
+            if stale_shard.rsplit('_', 1)[0] == df_row['dataset']:
+                shutil.rmtree(f'{config.db_shard_folder}/{stale_shard}')
+        func_args.append((
+            df_row['projectPath'], df_row['dataset'], df_row['allele'], df_row['cellLine'],
+            shard_path,
+        ))
+
+    print(f'Ingesting {len(func_args)} of {len(shard_paths)} projects...')
+    _run_ingestion(ingest_project_shard, func_args, config.n_cores)
+
+    return shard_paths
+
+
+def read_project_shards(shard_paths):
+    """ Function to read project shards into the dataframes for each stratum.
+    """
+    return {
+        name: [
+            pd.read_parquet(f'{shard_path}/{SHARD_FILE_NAMES[name]}.parquet')
+            for shard_path in shard_paths
+        ] for name in ALL_DFS_ORDER
+    }
+
+
+def scan_project_shards(shard_paths):
+    """ Function to lazily scan the project shards of each stratum.
+    """
+    return {
+        name: pl.scan_parquet([
+            f'{shard_path}/{SHARD_FILE_NAMES[name]}.parquet' for shard_path in shard_paths
+        ]) for name in ALL_DFS_ORDER
+    }
+
+
+def get_stratum_lazy_frames(all_dfs):
+    """ Function to convert the dataframes for each stratum into LazyFrames.
+    """
+    return {
+        name: pl.concat(
+            [pl.from_pandas(strat_df) for strat_df in strat_dfs], how='vertical_relaxed',
+        ).lazy() for name, strat_dfs in all_dfs.items()
+    }
+
+
+def get_project_hash(project_path, dataset, allele, cell_line):
+    """ Function to hash the metaDf entry of a project together with the sizes and
+        modification times of its input files.
+    """
+    project_hash = hashlib.md5(f'{dataset}|{allele}|{cell_line}|{project_path}'.encode())
+    for input_file in PROJECT_INPUT_FILES:
+        file_stat = os.stat(f'{project_path}/{input_file}')
+        project_hash.update(f'|{input_file}:{file_stat.st_size}:{file_stat.st_mtime_ns}'.encode())
+    return project_hash.hexdigest()[:16]
+
+
+def ingest_project_shard(project_path, dataset, allele, cell_line, shard_path):
+    """ Function to ingest a single PISCES project and write each stratum to a parquet
+        shard.
+    """
+    strat_dfs = ingest_project(project_path, dataset, allele, cell_line)
+    if os.path.exists(f'{shard_path}.tmp'):
+        shutil.rmtree(f'{shard_path}.tmp')
+    os.makedirs(f'{shard_path}.tmp')
+    for name, strat_df in strat_dfs.items():
+        strat_df = strat_df.astype({
+            column: 'string' for column in ['peptide', 'datasets', 'alleles', 'cellLines']
+        })
+        strat_df.to_parquet(f'{shard_path}.tmp/{SHARD_FILE_NAMES[name]}.parquet', index=False)
+    os.replace(f'{shard_path}.tmp', shard_path)
+    return shard_path
+
+
+def _run_ingestion(func, func_args, n_cores):
+    """ Helper function to run project ingestion in a process pool bounded by n_cores.
+    """
+    if n_cores > 1 and len(func_args) > 1:
+        with mp.get_context('spawn').Pool(processes=min(n_cores, len(func_args))) as pool:
+            return pool.starmap(func, func_args)
+    return [func(*args) for args in func_args]
+
+
+def ingest_project(project_path, dataset, allele, cell_line):
+    """ Function to load, filter and split the identifications of a single PISCES
+        project into the dataframes for each stratum.
+    """
+    remapped_df, td_df = get_identified_peptides(project_path)
+    details_dfs = read_details_files(project_path)
+
+    can_td_df = td_df[~td_df['mapsToContaminant']]
+    contam_td_df = td_df[td_df['mapsToContaminant']]
+    can_df, contam_df, nc_df = split_strata(remapped_df)
+    spliced_df, mm_df, cryptic_df, unmapped_df = split_nc_strata(nc_df)
+
+    strat_dfs = {}
+    for strat_df, name in zip(
+        [
+            can_td_df, contam_td_df, can_df, contam_df,
+            spliced_df, mm_df, cryptic_df, unmapped_df
+        ],
+        ALL_NAMES,
+    ):
+        id_df, details_df = get_details_df(strat_df, name, details_dfs)
+        strat_dfs[name] = combine_dfs(id_df, details_df, allele, cell_line, dataset, name)
+
+    return strat_dfs
+
+
 def get_identified_peptides(project_path):
     """ Function to get identified peptides via PISCES and t/d.
     """
@@ -185,23 +548,27 @@ def get_identified_peptides(project_path):
     return remapped_df, td_df
 
 
-def get_details_df(strat_df, name, project_path):
+def read_details_files(project_path):
+    """ Function to read the canonical, spliced and cryptic details of a project once.
+    """
+    details_dfs = {}
+    for name in ['canonical', 'spliced', 'cryptic']:
+        details_df = pd.read_csv(f'{project_path}/details/{name}.csv')
+        details_dfs[name] = details_df.drop_duplicates(subset=['peptide'])
+    return details_dfs
+
+
+def get_details_df(strat_df, name, details_dfs):
     """ Function to get details for each stratum.
     """
     if name in ['cryptic', 'spliced']:
-        details_df = pd.read_csv(f'{project_path}/details/{name}.csv')
-        details_df = details_df.drop_duplicates(subset=['peptide'])
+        details_df = details_dfs[name]
     elif name == 'multi-mapped':
-        details_spliced_df = pd.read_csv(f'{project_path}/details/spliced.csv')
-        details_cryptic_df = pd.read_csv(f'{project_path}/details/cryptic.csv')
-        details_spliced_df = details_spliced_df.drop_duplicates(subset=['peptide'])
-        details_cryptic_df = details_cryptic_df.drop_duplicates(subset=['peptide'])
         details_df = pd.merge(
-            details_spliced_df, details_cryptic_df, on=['peptide'], how='outer',
+            details_dfs['spliced'], details_dfs['cryptic'], on=['peptide'], how='outer',
         )
     elif name == 'canonical (pisces)':
-        details_df = pd.read_csv(f'{project_path}/details/canonical.csv')
-        details_df = details_df.drop_duplicates(subset=['peptide'])
+        details_df = details_dfs['canonical']
     elif name in ['canonical (t/d)', 'contam (t/d)']:
         code = name.split(' ')[0]
         strat_df = strat_df.rename(columns={'proteins': f'{code}_Proteins'})
@@ -233,6 +600,12 @@ def combine_dfs(id_df, details_df, allele, cell_line, dataset, name):
             else:
                 id_df[column] = ''
 
+        # Consistent nullable types so that strata can be written to and read from parquet.
+        if 'nProteins' in column or column in ['nCrypticProteins', 'nSplicedProteins']:
+            id_df[column] = id_df[column].astype('Int64')
+        else:
+            id_df[column] = id_df[column].astype('string')
+
     if 't/d' in name:
         id_df['adjustedProbability'] = 1 - id_df['postErrProb']
 
@@ -303,4 +676,4 @@ def _combine_lists(list_of_lists):
     total_list = []
     for entry in list_of_lists:
         total_list.extend(entry)
-    return list(set(total_list))
+    return sorted(set(total_list))
@@ -0,0 +1,343 @@
+""" Batched computation of the canonical/cryptic training features, computing sequence
+    derived lookups once per protein and all peptide hits within a protein in vectorised form.
+"""
+import multiprocessing as mp
+
+from Bio.SeqUtils.ProtParam import ProteinAnalysis
+import numpy as np
+import polars as pl
+
+from ppm.constants import (
+    AMINO_ACID_GROUPS,
+    START_CODONS,
+)
+from ppm.codon_index import CODON_INDEX_COLUMNS, index_codons
+from ppm.peptide_locator import locate_peptides
+from ppm.protein_cache import PROTEIN_FEATURE_COLUMNS, compute_protein_features
+
+# Minimum number of rows in each protein partition when features are computed in parallel.
+MIN_PARTITION_ROWS = 1_000
+HIT_FEATURES = (
+    ['position', 'il_peptide'] +
+    [f'{start_codon}_upstream' for start_codon in START_CODONS] +
+    ['start_dist', 'endCodon', 'postCodon']
+)
+FRAGMENT_FEATURES = (
+    ['relativePosition', 'localDisorder', 'stopDistances', 'fragmentLength'] +
+    [f'C_term_neg_1_{aa_group}' for aa_group in AMINO_ACID_GROUPS] +
+    ['C_term_neg_1_end', 'C_term_downstream', 'C_term_downstream_2',
+     'N_term_upstream', 'N_term_upstream_2']
+)
+FEATURE_SCHEMA = {
+    'peptideHydrophobicity': pl.Float64,
+    'protLength': pl.Int64,
+    **{f'C_term_{aa_group}': pl.Int64 for aa_group in AMINO_ACID_GROUPS},
+    **{f'{nucleotide}_frac': pl.Float64 for nucleotide in 'AUGC'},
+    'position': pl.List(pl.Int64),
+    'il_peptide': pl.List(pl.String),
+    **{f'{start_codon}_upstream': pl.List(pl.Int64) for start_codon in START_CODONS},
+    'start_dist': pl.List(pl.Int64),
+    'endCodon': pl.List(pl.String),
+    'postCodon': pl.List(pl.String),
+    'kozakScore': pl.Float64,
+    'relativePosition': pl.List(pl.Float64),
+    'localDisorder': pl.List(pl.Float64),
+    'stopDistances': pl.List(pl.Int64),
+    'fragmentLength': pl.List(pl.Int64),
+    **{f'C_term_neg_1_{aa_group}': pl.List(pl.Int64) for aa_group in AMINO_ACID_GROUPS},
+    'C_term_neg_1_end': pl.List(pl.Int64),
+    'C_term_downstream': pl.List(pl.String),
+    'C_term_downstream_2': pl.List(pl.String),
+    'N_term_upstream': pl.List(pl.String),
+    'N_term_upstream_2': pl.List(pl.String),
+}
+HIT_SCHEMA = {
+    'rowIdx': pl.UInt32,
+    **{feature: FEATURE_SCHEMA[feature].inner for feature in HIT_FEATURES + FRAGMENT_FEATURES},
+    'kozakScore': pl.Float64,
+}
+
+
+def create_features_partitioned(
+    total_pep_df, codon_index_df=None, protein_features_df=None, n_cores=1,
+):
+    """ Function to create the features of create_features_batched with the rows split into
+        groups of whole proteins, which are processed in a pool bounded by n_cores.
+    """
+    n_partitions = min(n_cores, total_pep_df.shape[0]//MIN_PARTITION_ROWS)
+    if n_partitions <= 1:
+        return create_features_batched(total_pep_df, codon_index_df, protein_features_df)
+
+    part_dfs = total_pep_df.with_row_index('partitionRowIdx').with_columns(
+        get_protein_partitions(total_pep_df, n_partitions)
+    ).partition_by('partition', include_key=False)
+    func_args = []
+    for part_df in part_dfs:
+        protein_ids = part_df.select('proteinID').unique()
+        func_args.append((
+            part_df.drop('partitionRowIdx'),
+            None if codon_index_df is None else codon_index_df.join(
+                protein_ids, how='semi', on='proteinID',
+            ),
+            None if protein_features_df is None else protein_features_df.join(
+                protein_ids, how='semi', on='proteinID',
+            ),
+        ))
+    with mp.get_context('spawn').Pool(processes=n_partitions) as pool:
+        features_dfs = pool.starmap(create_features_batched, func_args)
+
+    return pl.concat([
+        features_df.with_columns(part_df['partitionRowIdx'])
+        for features_df, part_df in zip(features_dfs, part_dfs)
+    ]).sort('partitionRowIdx').drop('partitionRowIdx')
+
+
+def get_protein_partitions(total_pep_df, n_partitions):
+    """ Function to assign the rows to at most n_partitions partitions of whole proteins.
+        Proteins are added in order until a partition holds its share of the rows, and a
+        smaller last partition is merged into the one before, so that every partition holds
+        at least MIN_PARTITION_ROWS rows when n_partitions allows it.
+    """
+    prot_counts = total_pep_df.group_by('proteinID', maintain_order=True).len()
+    partition_rows = total_pep_df.shape[0]/n_partitions
+    partitions = []
+    partition = 0
+    n_rows = 0
+    for n_prot_rows in prot_counts['len'].to_list():
+        partitions.append(partition)
+        n_rows += n_prot_rows
+        if n_rows >= partition_rows:
+            partition += 1
+            n_rows = 0
+    if 0 < n_rows < MIN_PARTITION_ROWS and partition > 0:
+        partitions = [min(prot_partition, partition - 1) for prot_partition in partitions]
+
+    return total_pep_df.select('proteinID').join(
+        prot_counts.select(
+            'proteinID', pl.Series('partition', partitions, dtype=pl.UInt32),
+        ),
+        how='left', on='proteinID', maintain_order='left',
+    )['partition']
+
+
+def create_features_batched(total_pep_df, codon_index_df=None, protein_features_df=None):
+    """ Function to create the training features for all rows of a DataFrame
+        with peptide, proteinID, protSeq, rnaSeq and iupred3_preds columns. Codon lookups
+        use the ORF codon index and protein level features are taken from the protein
+        features if given, otherwise both are computed for the proteins of the DataFrame.
+    """
+    prot_groups = total_pep_df.with_row_index('rowIdx').group_by(
+        'proteinID', maintain_order=True
+    ).agg(
+        pl.col('rowIdx'),
+        pl.col('peptide'),
+        pl.col('protSeq').first(),
+        pl.col('rnaSeq').first(),
+        pl.col('iupred3_preds').first(),
+    )
+    codon_indices = _get_codon_indices(codon_index_df, prot_groups['proteinID'])
+    hit_features = [
+        _get_protein_hits(
+            row_idxs, peptides, prot_seq, rna_seq, iupred3_preds, codon_indices.get(protein_id),
+        )
+        for (
+            protein_id, row_idxs, peptides, prot_seq, rna_seq, iupred3_preds
+        ) in prot_groups.iter_rows()
+    ]
+
+    # Hit level features are gathered into lists per row, rows without hits get empty lists.
+    hits_df = pl.DataFrame(
+        {
+            feature: (
+                np.concatenate([hits[feature] for hits in hit_features])
+                if hit_features else []
+            ) for feature, dtype in HIT_SCHEMA.items()
+        },
+        schema=HIT_SCHEMA,
+    ).with_columns(
+        pl.when(pl.col('AUG_upstream') == 1).then(pl.col('start_dist')),
+        pl.when(pl.col('kozakScore').is_not_nan()).then(pl.col('kozakScore')),
+    )
+    hits_df = hits_df.group_by('rowIdx').agg(
+        *[pl.col(feature) for feature in HIT_FEATURES + FRAGMENT_FEATURES],
+        pl.col('kozakScore').drop_nulls().last(),
+    )
+    features_df = pl.DataFrame(
+        {'rowIdx': np.arange(total_pep_df.shape[0], dtype=np.uint32)}
+    ).join(hits_df, on='rowIdx', how='left').sort('rowIdx').with_columns(
+        pl.col(feature).fill_null(pl.lit([], dtype=FEATURE_SCHEMA[feature]))
+        for feature in HIT_FEATURES + FRAGMENT_FEATURES
+    )
+
+    # Peptide level features are computed once per distinct peptide.
+    hydrophobicity = {
+        peptide: ProteinAnalysis(peptide).gravy()
+        for peptide in total_pep_df['peptide'].unique().to_list()
+    }
+    features_df = features_df.with_columns(
+        pl.Series(
+            'peptideHydrophobicity',
+            [hydrophobicity[peptide] for peptide in total_pep_df['peptide'].to_list()],
+            dtype=pl.Float64,
+        ),
+        *[
+            total_pep_df['peptide'].str.slice(-1).is_in(aa_list).cast(pl.Int64).alias(
+                f'C_term_{aa_group}'
+            ) for aa_group, aa_list in AMINO_ACID_GROUPS.items()
+        ],
+    )
+
+    # Protein level features are joined onto the rows of each protein.
+    if protein_features_df is None:
+        protein_features_df = compute_protein_features(
+            total_pep_df.select(['proteinID', 'protSeq', 'rnaSeq']).unique(
+                subset='proteinID', maintain_order=True,
+            )
+        )
+    features_df = pl.concat(
+        [features_df, total_pep_df.select('proteinID')], how='horizontal',
+    ).join(
+        protein_features_df.select(['proteinID'] + PROTEIN_FEATURE_COLUMNS),
+        how='left', on='proteinID',
+    ).sort('rowIdx')
+    return features_df.select(
+        pl.col(feature).cast(dtype) for feature, dtype in FEATURE_SCHEMA.items()
+    )
+
+
+def _get_codon_indices(codon_index_df, protein_ids):
+    """ Helper function to get the codon index arrays of each protein from the codon index,
+        as views on the flattened index columns.
+    """
+    if codon_index_df is None:
+        return {}
+    codon_index_df = codon_index_df.join(protein_ids.to_frame(), on='proteinID', how='semi')
+    offsets = np.zeros(codon_index_df.shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(codon_index_df['prevStop'].list.len().to_numpy())
+    # Empty lists are dropped before exploding as they would explode to a null entry.
+    non_empty_df = codon_index_df.filter(pl.col('prevStop').list.len() > 0)
+    flat_columns = {
+        column: non_empty_df[column].explode().to_numpy() for column in CODON_INDEX_COLUMNS
+    }
+    return {
+        protein_id: {
+            column: flat_column[offsets[idx]:offsets[idx+1]]
+            for column, flat_column in flat_columns.items()
+        } for idx, protein_id in enumerate(codon_index_df['proteinID'].to_list())
+    }
+
+
+def _get_protein_hits(row_idxs, peptides, prot_seq, rna_seq, iupred3_preds, codon_index):
+    """ Helper function to compute the features of every hit of the peptides mapped to a
+        single protein, returned as flat arrays with one entry per hit.
+    """
+    il_prot_seq = prot_seq.replace('I', 'L')
+    prot_length = len(prot_seq)
+    hit_rows, hit_positions, hit_lengths = [], [], []
+    for row_idx, peptide, positions in zip(
+        row_idxs, peptides, locate_peptides(peptides, il_prot_seq),
+    ):
+        hit_rows.extend([row_idx]*len(positions))
+        hit_positions.extend(positions)
+        hit_lengths.extend([len(peptide)]*len(positions))
+    hits = np.asarray(hit_positions, dtype=np.int64)
+    pep_lens = np.asarray(hit_lengths, dtype=np.int64)
+    pep_ends = hits + pep_lens
+
+    features = {
+        'rowIdx': np.asarray(hit_rows, dtype=np.uint32),
+        'position': hits,
+        'il_peptide': np.array([
+            prot_seq[pos:pos_end] for pos, pos_end in zip(hit_positions, pep_ends.tolist())
+        ], dtype=object),
+        'endCodon': np.array([
+            rna_seq[(pos_end-1)*3:pos_end*3] for pos_end in pep_ends.tolist()
+        ], dtype=object),
+        'postCodon': np.array([
+            rna_seq[pos_end*3:(pos_end+1)*3] for pos_end in pep_ends.tolist()
+        ], dtype=object),
+        'relativePosition': hits/prot_length if prot_length else hits.astype(np.float64),
+        'localDisorder': _get_local_disorder(
+            np.asarray(iupred3_preds, dtype=np.float64), hits, pep_lens,
+        ),
+    }
+
+    # Upstream start codons are searched back to the nearest in frame stop codon.
+    if codon_index is None:
+        codon_index = index_codons(rna_seq)
+    scan_starts = _lookup(codon_index['prevStop'], hits) + 1
+    for start_codon in START_CODONS:
+        upstream_idx = _lookup(codon_index[f'prev_{start_codon}'], hits)
+        upstream = (upstream_idx >= 0) & (upstream_idx >= scan_starts)
+        features[f'{start_codon}_upstream'] = upstream.astype(np.int64)
+        if start_codon == 'AUG':
+            # Masked to null where there is no upstream AUG, as is the Kozak score (NaN).
+            features['start_dist'] = hits - upstream_idx
+            features['kozakScore'] = np.where(
+                upstream, _lookup(codon_index['kozakScores'], upstream_idx), np.nan,
+            )
+
+    # Fragments are the regions of the protein between stop codons.
+    prot_bytes = np.frombuffer(prot_seq.encode('ascii'), dtype=np.uint8)
+    stop_positions = np.flatnonzero(prot_bytes == ord('*'))
+    next_stop = np.searchsorted(stop_positions, pep_ends, side='left')
+    features['stopDistances'] = np.where(
+        next_stop < len(stop_positions),
+        stop_positions[np.minimum(next_stop, len(stop_positions) - 1)] - pep_ends
+        if len(stop_positions) else 0,
+        np.maximum(prot_length - pep_ends, 0),
+    )
+    frag_idx = np.searchsorted(stop_positions, hits, side='left')
+    frag_starts = np.concatenate([[0], stop_positions + 1])[frag_idx]
+    frag_ends = np.concatenate([stop_positions, [prot_length]])[frag_idx]
+    features['fragmentLength'] = frag_ends - frag_starts
+
+    c_term_downstream = _residues_in_fragment(prot_bytes, pep_ends, frag_starts, frag_ends)
+    for aa_group, aa_list in AMINO_ACID_GROUPS.items():
+        features[f'C_term_neg_1_{aa_group}'] = np.isin(
+            c_term_downstream, [ord(aa) for aa in aa_list],
+        ).astype(np.int64)
+    features['C_term_neg_1_end'] = (c_term_downstream == ord('X')).astype(np.int64)
+    for feature, residues in [
+        ('C_term_downstream', c_term_downstream),
+        ('C_term_downstream_2', _residues_in_fragment(
+            prot_bytes, pep_ends + 1, frag_starts, frag_ends,
+        )),
+        ('N_term_upstream', _residues_in_fragment(prot_bytes, hits - 1, frag_starts, frag_ends)),
+        ('N_term_upstream_2', _residues_in_fragment(prot_bytes, hits - 2, frag_starts, frag_ends)),
+    ]:
+        features[feature] = residues.view('S1').astype(str)
+    return features
+
+
+def _get_local_disorder(disorder, hits, pep_lens):
+    """ Helper function to get the mean disorder prediction over each hit.
+    """
+    local_disorder = np.empty(len(hits), dtype=np.float64)
+    for pep_len in np.unique(pep_lens):
+        in_range = (pep_lens == pep_len) & (hits + pep_len <= len(disorder))
+        if len(disorder) >= pep_len and in_range.any():
+            windows = np.lib.stride_tricks.sliding_window_view(disorder, pep_len)
+            local_disorder[in_range] = windows[hits[in_range]].mean(axis=1)
+        for hit_idx in np.flatnonzero((pep_lens == pep_len) & ~in_range):
+            local_disorder[hit_idx] = np.mean(disorder[hits[hit_idx]:hits[hit_idx]+pep_len])
+    return local_disorder
+
+
+def _lookup(index_column, positions):
+    """ Helper function to look up codon index entries at positions, positions past the last
+        codon take the entry of the last codon and the lookup is -1 for an empty index.
+    """
+    if not len(index_column):
+        return np.full(len(positions), -1, dtype=index_column.dtype)
+    return index_column[np.clip(positions, 0, len(index_column) - 1)]
+
+
+def _residues_in_fragment(prot_bytes, indices, frag_starts, frag_ends):
+    """ Helper function to get the residue codes at indices, padded with X outside of the
+        fragment.
+    """
+    in_fragment = (indices >= frag_starts) & (indices < frag_ends)
+    residues = np.full(len(indices), ord('X'), dtype=np.uint8)
+    residues[in_fragment] = prot_bytes[indices[in_fragment]]
+    return residues
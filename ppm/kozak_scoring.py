@@ -30,39 +30,36 @@ KOZAK_SIMILARITY_WEIGHTS = np.array([
        [0.0625    , 0.04210526, 0.09473684, 0.05263158, 0.        ]
 ])
 
+KOZAK_WINDOW_LENGTH = 23
+# Normaliser to give scores in the range 0 to 1, the maximum possible score.
+KOZAK_MAX_SCORE = np.sum(KOZAK_SIMILARITY_WEIGHTS.max(axis=1))
+# Lookup from (upper case) base to weight column, U scored as T and anything else as 4.
+KOZAK_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base_code, bases in enumerate(['Aa', 'TtUu', 'Gg', 'Cc']):
+    KOZAK_BASE_CODES[np.frombuffer(bases.encode(), dtype=np.uint8)] = base_code
+
+
 def kozak_similarity_score(sequence):
     """ Function to calculate the Kozak similarity score for a given sequence taken from
         https://github.com/Agleason1/TIS-Predictor/blob/main/Koazk_Similarity_Score_Algorithm.ipynb
     """
-    assert len(sequence)==23,'Sequence must be 23 bases long. Codon of interest must be centered, with 10 bases flanking both sides.'
-    #We need consistency and flexibility:
-    sequence = sequence.upper()
-    for i in np.arange(len(sequence)):
-        if sequence[i] =='U':
-            sequence = sequence[0:i]+'T'+sequence[i+1:len(sequence)]
-
-    numbers=[0]*len(sequence)
+    return kozak_similarity_scores([sequence])[0]
 
-    for k in np.arange(len(sequence)):
-        if sequence[k]=='A':
-            numbers[k] = 0
-        elif sequence[k]=='T':
-            numbers[k] = 1
-        elif sequence[k]=='G':
-            numbers[k] = 2
-        elif sequence[k]=='C':
-            numbers[k] = 3
-        else:
-            numbers[k]=4
 
-    score = 0
-    for k in np.arange(len(numbers)):
-        score += KOZAK_SIMILARITY_WEIGHTS[k][numbers[k]]
-
-    max_score = np.sum(KOZAK_SIMILARITY_WEIGHTS.max(axis=1))
-
-    score = score/max_score
+def kozak_similarity_scores(sequences):
+    """ Function to calculate the Kozak similarity scores of a batch of 23 base sequences,
+        with the codon of interest centered, as an array.
+    """
+    assert all(len(sequence) == KOZAK_WINDOW_LENGTH for sequence in sequences), (
+        'Sequence must be 23 bases long. Codon of interest must be centered, with 10 bases '
+        'flanking both sides.'
+    )
+    base_codes = KOZAK_BASE_CODES[
+        np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+    ].reshape(len(sequences), KOZAK_WINDOW_LENGTH)
 
-    #Final scoring value: we take the maximum possible score 
-    #calculated, and return our score divided by the maximum (to normalize from range 0 to 1) 
-    return(score)
+    # Weights are summed position by position as in the original algorithm.
+    scores = np.zeros(len(sequences), dtype=np.float64)
+    for position in range(KOZAK_WINDOW_LENGTH):
+        scores += KOZAK_SIMILARITY_WEIGHTS[position][base_codes[:, position]]
+    return scores/KOZAK_MAX_SCORE
@@ -0,0 +1,103 @@
+""" Functions to locate a batch of peptides within a protein sequence in a single pass, giving
+    the same non-overlapping occurrences as re.finditer on each peptide.
+"""
+import numpy as np
+
+# Below this many peptides of a length a scan with str.find per peptide is faster than
+# building the k-mer index of the protein.
+MIN_INDEXED_PEPTIDES = 100
+# Residues are packed into 5 bits each, so up to 12 residues fit in one 64 bit k-mer code.
+MAX_INDEXED_LENGTH = 12
+RESIDUE_CODES = np.zeros(256, dtype=np.uint64)
+RESIDUE_CODES[np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ*', dtype=np.uint8)] = np.arange(
+    1, 28, dtype=np.uint64
+)
+
+
+def locate_peptides(peptides, prot_seq):
+    """ Function to locate all peptides in a protein sequence, returning the sorted start
+        positions of the non-overlapping occurrences of each peptide.
+    """
+    positions = [[] for _ in peptides]
+    peptides_by_length = {}
+    for pep_idx, peptide in enumerate(peptides):
+        peptides_by_length.setdefault(len(peptide), []).append(pep_idx)
+
+    for pep_len, pep_idxs in peptides_by_length.items():
+        if (
+            len(pep_idxs) < MIN_INDEXED_PEPTIDES or
+            not 0 < pep_len <= min(MAX_INDEXED_LENGTH, len(prot_seq)) or
+            not _is_encodable(prot_seq + ''.join(peptides[pep_idx] for pep_idx in pep_idxs))
+        ):
+            for pep_idx in pep_idxs:
+                positions[pep_idx] = find_non_overlapping(peptides[pep_idx], prot_seq)
+            continue
+        for pep_idx, pep_positions in zip(
+            pep_idxs, _locate_kmers([peptides[pep_idx] for pep_idx in pep_idxs], prot_seq),
+        ):
+            positions[pep_idx] = pep_positions
+    return positions
+
+
+def find_non_overlapping(peptide, prot_seq):
+    """ Function to find the non-overlapping occurrences of a single peptide.
+    """
+    positions = []
+    position = prot_seq.find(peptide)
+    while position != -1:
+        positions.append(position)
+        position = prot_seq.find(peptide, position + len(peptide))
+    return positions
+
+
+def _locate_kmers(peptides, prot_seq):
+    """ Helper function to locate peptides of equal length by matching the k-mer codes of
+        every position in the protein against the sorted codes of the peptides.
+    """
+    pep_len = len(peptides[0])
+    prot_kmers = _encode_kmers(prot_seq, pep_len)
+    pep_kmers, pep_kmer_idx = np.unique(
+        _encode_kmers(''.join(peptides), pep_len)[::pep_len], return_inverse=True,
+    )
+
+    kmer_idx = np.minimum(np.searchsorted(pep_kmers, prot_kmers), len(pep_kmers) - 1)
+    is_hit = pep_kmers[kmer_idx] == prot_kmers
+    hits = np.flatnonzero(is_hit)
+    hit_kmer_idx = kmer_idx[is_hit]
+    order = np.argsort(hit_kmer_idx, kind='stable')
+    hits, hit_kmer_idx = hits[order], hit_kmer_idx[order]
+    bounds = np.searchsorted(hit_kmer_idx, np.arange(len(pep_kmers) + 1))
+
+    kmer_positions = [
+        _drop_overlaps(hits[bounds[idx]:bounds[idx+1]], pep_len) for idx in range(len(pep_kmers))
+    ]
+    return [kmer_positions[idx] for idx in pep_kmer_idx.ravel().tolist()]
+
+
+def _is_encodable(sequence):
+    """ Helper function to check that a sequence only contains residues with a k-mer code.
+    """
+    return bool(RESIDUE_CODES[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)].all())
+
+
+def _encode_kmers(sequence, pep_len):
+    """ Helper function to encode the k-mer starting at each position of a sequence.
+    """
+    codes = RESIDUE_CODES[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+    n_kmers = len(codes) - pep_len + 1
+    kmers = np.zeros(n_kmers, dtype=np.uint64)
+    for offset in range(pep_len):
+        kmers = (kmers << np.uint64(5)) | codes[offset:offset+n_kmers]
+    return kmers
+
+
+def _drop_overlaps(hits, pep_len):
+    """ Helper function to keep the leftmost non-overlapping hits, as re.finditer.
+    """
+    if len(hits) < 2 or np.diff(hits).min() >= pep_len:
+        return hits.tolist()
+    positions = []
+    for hit in hits.tolist():
+        if not positions or hit >= positions[-1] + pep_len:
+            positions.append(hit)
+    return positions
@@ -1,10 +1,13 @@
 """ Functions for pre-processing canonical or cryptic peptides.
 """
-import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+import multiprocessing as mp
+import os
+from time import perf_counter
+import traceback
 import warnings
 
-from Bio.SeqUtils.ProtParam import ProteinAnalysis
-import numpy as np
 import polars as pl
 
 
@@ -13,16 +16,33 @@ from ppm.constants import (
     CRYPTIC_STRATA,
     ID_COLUMNS,
     START_CODONS,
-    STOP_CODONS,
 )
-from ppm.preprocess_utils import merge_orf_level_data, get_sampled_negative_peps
-from ppm.kozak_scoring import kozak_similarity_score
+from ppm.codon_index import get_codon_index
+from ppm.feature_engine import create_features_partitioned
+from ppm.protein_cache import get_protein_features
+from ppm.preprocess_utils import (
+    get_min_sampled_count,
+    get_sampled_negative_peps,
+    get_sampling_draws,
+    merge_orf_level_data,
+    read_background,
+    read_sample_ratios,
+    sample_negative_peps,
+)
 warnings.filterwarnings('ignore')
 
 
 def preprocess_canonical(config):
     """ Function to preprocess canonical peptides.
     """
+    if config.single_pass_preprocess and config.parallel_preprocess:
+        raise ValueError('singlePassPreprocess cannot be used with parallelPreprocess.')
+    if config.single_pass_preprocess:
+        preprocess_single_pass(config, ['canonical'], False)
+        return
+    if config.parallel_preprocess:
+        run_preprocessing_jobs(config, ['canonical'], False)
+        return
     for pep_len in range(9, 13):
         print(f'\t\t\tprocessing length {pep_len}...')
         process_stratum('canonical', False, config, pep_len)
@@ -32,6 +52,14 @@ def preprocess_cryptic(config):
     """ Function run to process uniquely mapped peptides attributed to each stratum.
     """
     print(f'\tprocessing cell line {config.cell_line}')
+    if config.single_pass_preprocess and config.parallel_preprocess:
+        raise ValueError('singlePassPreprocess cannot be used with parallelPreprocess.')
+    if config.single_pass_preprocess:
+        preprocess_single_pass(config, CRYPTIC_STRATA, True)
+        return
+    if config.parallel_preprocess:
+        run_preprocessing_jobs(config, CRYPTIC_STRATA, True)
+        return
     for stratum in CRYPTIC_STRATA:
         print(f'\t\tprocessing stratum {stratum}...')
         for pep_len in range(9, 13):
@@ -39,7 +67,7 @@ def preprocess_cryptic(config):
             process_stratum(stratum, True, config, pep_len)
 
 
-def process_stratum(stratum, is_cryptic, config, pep_len):
+def process_stratum(stratum, is_cryptic, config, pep_len, draws=None, n_cores=1):
     """ Function to process data
 
     stratum : str
@@ -48,13 +76,124 @@ def process_stratum(stratum, is_cryptic, config, pep_len):
         Is the stratum cryptic
     cell_line : str
         The cell line being processed
+    draws : np.ndarray or None
+        Random numbers for negative sampling, drawn from the global RNG if None
+    n_cores : int
+        Cores used for feature creation, more than one only within parallel preprocessing
     """
     # Gather and format positives samples - pisces identified peptides
     # and negative samples - random background peptides with matched amino
     # acid distribution.
     pos_pep_df = gather_positive_samples(stratum, is_cryptic, config, pep_len, False)
-    neg_pep_df = gather_negative_samples(stratum, is_cryptic, config, pep_len)
+    neg_pep_df = gather_negative_samples(stratum, is_cryptic, config, pep_len, draws)
+    write_training_dataset(
+        pos_pep_df, neg_pep_df, stratum, is_cryptic, config, pep_len, n_cores,
+    )
+
+
+def run_preprocessing_jobs(config, strata, is_cryptic):
+    """ Function to process every stratum and peptide length as an independent job, running
+        up to config.n_cores jobs at once. Each job logs to its own file in the logs folder
+        and a failed job does not stop the others.
+    """
+    pep_lens = list(range(9, 13))
+    draws = get_sampling_draws(config, pep_lens, is_cryptic, strata)
+    jobs = [(stratum, pep_len) for stratum in strata for pep_len in pep_lens]
+    n_workers = max(1, min(config.n_cores, len(jobs)))
+    job_cores = max(1, config.n_cores//n_workers)
+    log_folder = f'{config.output_folder}/logs'
+    os.makedirs(log_folder, exist_ok=True)
+
+    # The per stratum files shared by the length jobs are written once before they start.
+    for stratum in strata:
+        get_codon_index(config, stratum)
+        if config.protein_feature_cache:
+            get_protein_features(config, stratum)
+
+    failed_jobs = []
+    # Executor workers are not daemonic, so each job may use its own pool for features.
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=mp.get_context('spawn'),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_preprocessing_job, stratum, is_cryptic, config, pep_len,
+                draws[(stratum, pep_len)], job_cores,
+                f'{log_folder}/preprocess_{stratum}_{pep_len}.log',
+            ): (stratum, pep_len) for stratum, pep_len in jobs
+        }
+        for future in as_completed(futures):
+            stratum, pep_len = futures[future]
+            try:
+                error = future.result()
+            except Exception as err:
+                error = repr(err)
+            if error is None:
+                print(f'\t\tfinished stratum {stratum}, length {pep_len}')
+            else:
+                print(f'\t\tfailed stratum {stratum}, length {pep_len}: {error}')
+                failed_jobs.append(f'{stratum}_{pep_len}')
+
+    if failed_jobs:
+        raise RuntimeError(
+            f'Preprocessing failed for {", ".join(failed_jobs)}, see logs in {log_folder}.'
+        )
+
+
+def run_preprocessing_job(stratum, is_cryptic, config, pep_len, draws, n_cores, log_file):
+    """ Function to run process_stratum for one job with its output written to log_file,
+        returning None on success or the error on failure.
+    """
+    with open(log_file, 'w', encoding='UTF-8') as log, redirect_stdout(log), redirect_stderr(log):
+        start_time = perf_counter()
+        print(f'processing stratum {stratum}, length {pep_len}...')
+        try:
+            process_stratum(stratum, is_cryptic, config, pep_len, draws, n_cores)
+        except Exception as err:
+            traceback.print_exc()
+            return repr(err)
+        print(f'finished in {perf_counter() - start_time:.1f}s')
+    return None
+
+
+def preprocess_single_pass(config, strata, is_cryptic):
+    """ Function to process all strata and peptide lengths while reading the peptides parquet
+        and each background dataset only once, giving the same training datasets as
+        process_stratum on each stratum and length.
+    """
+    pep_lens = list(range(9, 13))
+    pos_pep_df = read_positive_samples(config, strata, pep_lens)
+    draws = get_sampling_draws(config, pep_lens, is_cryptic, strata)
 
+    for pep_len in pep_lens:
+        print(f'\t\t\tprocessing length {pep_len}...')
+        sample_vals = read_sample_ratios(config, pep_len)
+        background = read_background(config, pep_len, is_cryptic, strata)
+        for stratum in strata:
+            print(f'\t\tprocessing stratum {stratum}...')
+            stratum_pos_df = merge_orf_level_data(
+                filter_positive_samples(pos_pep_df, stratum, is_cryptic, pep_len, False),
+                config, stratum, 1, ID_COLUMNS,
+            )
+            pep_dfs = sample_negative_peps(
+                background[stratum].items(),
+                sample_vals,
+                get_min_sampled_count(background[stratum].items(), sample_vals),
+                stratum,
+                iter(draws[(stratum, pep_len)]),
+            )
+            write_training_dataset(
+                stratum_pos_df, format_negative_samples(pep_dfs, stratum, config),
+                stratum, is_cryptic, config, pep_len,
+            )
+
+
+def write_training_dataset(
+    pos_pep_df, neg_pep_df, stratum, is_cryptic, config, pep_len, n_cores=1,
+):
+    """ Function to combine positive and negative samples, add features and write the
+        training dataset of a stratum and peptide length.
+    """
     if pos_pep_df is None and neg_pep_df is None:
         return
 
@@ -67,7 +206,10 @@ def process_stratum(stratum, is_cryptic, config, pep_len):
     )
 
     # Additional features for cryptic and canonical peptides.
-    total_pep_df = add_features(total_pep_df)
+    total_pep_df = add_features(
+        total_pep_df, get_codon_index(config, stratum), get_protein_features(config, stratum),
+        n_cores,
+    )
 
     if is_cryptic:
         total_pep_df = total_pep_df.with_columns(
@@ -80,21 +222,41 @@ def process_stratum(stratum, is_cryptic, config, pep_len):
 def gather_positive_samples(stratum, is_cryptic, config, pep_len, is_mm):
     """ Function get positive peptides.
     """
+    pos_pep_df = read_positive_samples(config, [stratum], [pep_len])
+    return merge_orf_level_data(
+        filter_positive_samples(pos_pep_df, stratum, is_cryptic, pep_len, is_mm),
+        config, stratum, 1, ID_COLUMNS,
+    )
+
+
+def read_positive_samples(config, strata, pep_lens):
+    """ Function to read the discoverable peptides of the cell line with the given lengths,
+        with the protein columns of each stratum.
+    """
     # Read in data, get 9mer, K562 data only:
     pos_pep_df = pl.read_parquet(
         config.peptides_pq,
         columns=[
             'peptide', 'stratum', 'cellLines', 'piscesDiscoverable',
-            f'{stratum}_nProteins', f'{stratum}_Proteins',
+        ] + [
+            column for stratum in strata
+            for column in (f'{stratum}_nProteins', f'{stratum}_Proteins')
+        ] + [
             'fusion_nProteins', 'mutation_nProteins', 'TrEMBL_nProteins'
         ],
     )
-    pos_pep_df = pos_pep_df.filter(
+    return pos_pep_df.filter(
         pl.col('cellLines').list.contains(config.cell_line) &
-        pl.col('peptide').str.len_chars().eq(pep_len) &
+        pl.col('peptide').str.len_chars().is_in(pep_lens) &
         pl.col('piscesDiscoverable').eq(1)
     )
 
+
+def filter_positive_samples(pos_pep_df, stratum, is_cryptic, pep_len, is_mm):
+    """ Function to filter the positive peptides of a stratum and length, one row per protein.
+    """
+    pos_pep_df = pos_pep_df.filter(pl.col('peptide').str.len_chars().eq(pep_len))
+
     # Filter to unique in that stratum:
     if is_mm:
         pos_pep_df = pos_pep_df.filter(
@@ -111,137 +273,49 @@ def gather_positive_samples(stratum, is_cryptic, config, pep_len, is_mm):
             pl.col('stratum').eq(stratum)
         )
 
-    pos_pep_df = pos_pep_df.drop(['fusion_nProteins', 'mutation_nProteins', 'TrEMBL_nProteins'])
+    pos_pep_df = pos_pep_df.select(
+        ['peptide', 'stratum', 'cellLines', 'piscesDiscoverable', f'{stratum}_nProteins',
+         f'{stratum}_Proteins']
+    )
     # Explode columns with different possible accessions listed:
-    pos_pep_df = pos_pep_df.rename({f'{stratum}_Proteins': 'proteinID'}).explode('proteinID')
+    return pos_pep_df.rename({f'{stratum}_Proteins': 'proteinID'}).explode('proteinID')
 
-    return merge_orf_level_data(pos_pep_df, config, stratum, 1, ID_COLUMNS)
 
-
-def gather_negative_samples(stratum, is_cryptic, config, pep_len):
+def gather_negative_samples(stratum, is_cryptic, config, pep_len, draws=None):
     """ Function to get random background peptides for a given stratum and cell line.
     """
     # Collect negative samples from relevant cell line.
-    pep_dfs = get_sampled_negative_peps(config, pep_len, is_cryptic, stratum)
+    pep_dfs = get_sampled_negative_peps(config, pep_len, is_cryptic, stratum, draws)
+    return format_negative_samples(pep_dfs, stratum, config)
+
+
+def format_negative_samples(pep_dfs, stratum, config):
+    """ Function to combine sampled background peptides, one row per protein.
+    """
     if not pep_dfs:
         return None
 
-    neg_pep_df = pl.concat(pep_dfs)
-    neg_pep_df = neg_pep_df.with_columns(
-        pl.col(f'{stratum}_Proteins').map_elements(
-            lambda x : [a for a in x.split(' ') if a]
-        )
-    ).explode(f'{stratum}_Proteins')
+    neg_pep_df = pl.concat(pep_dfs).explode(f'{stratum}_Proteins')
     neg_pep_df = neg_pep_df.rename({f'{stratum}_Proteins': 'proteinID'})
 
     return merge_orf_level_data(neg_pep_df, config, stratum, 0, ID_COLUMNS)
 
 
-def create_features(peptide, prot_seq, rna_seq, iupred3_preds):
-    """ Function to create features that may be relevant for model training.
-    """
-    pep_analysis = ProteinAnalysis(peptide)
-    il_prot_seq = prot_seq.replace('I', 'L')
-    pep_len = len(peptide)
-    results = {}
-
-    results['peptideHydrophobicity'] = pep_analysis.gravy()
-    results['protLength'] = len(prot_seq)
-
-    for aa_group, aa_list in AMINO_ACID_GROUPS.items():
-        results[f'C_term_{aa_group}'] = int(peptide[-1] in aa_list)
-    for nucleotide in 'AUGC':
-        results[f'{nucleotide}_frac'] = rna_seq.count(nucleotide)/len(rna_seq)
-
-    results['position'] = [
-        occ.start() for occ in re.finditer(peptide, il_prot_seq)
-    ]
-    results['il_peptide'] = [
-        prot_seq[pos:pos+pep_len] for pos in results['position']
-    ]
-
-    for start_codon in START_CODONS:
-        results[f'{start_codon}_upstream'] = [0 for _ in results['position']]
-    results['start_dist'] = [None for _ in results['position']]
-    results['endCodon'] = [
-        rna_seq[(position+pep_len-1)*3:(position+pep_len)*3] for position in results['position']
-    ]
-    results['postCodon'] = [
-        rna_seq[(position+pep_len)*3:(position+pep_len+1)*3] for position in results['position']
-    ]
-    results['kozakScore'] = None
-    for pos_idx, position in enumerate(results['position']):
-        for idx in range(position, -1, -1):
-            codon = rna_seq[idx*3:(idx+1)*3]
-            if codon in STOP_CODONS:
-                break
-            for start_codon in START_CODONS:
-                if codon == start_codon:
-                    results[f'{start_codon}_upstream'][pos_idx] = 1
-                    distance = position - idx
-                    if (
-                        results['start_dist'][pos_idx] is None or
-                        results['start_dist'][pos_idx] > distance
-                    ) and codon == 'AUG':
-                        results['start_dist'][pos_idx] = position - idx
-                        if idx*3 > 10 and (idx*3) + 13 < len(rna_seq):
-                            results['kozakScore'] = kozak_similarity_score(
-                                rna_seq[(idx*3)-10:(idx*3)+13]
-                            )
-
-    results['relativePosition'] = [
-        pos/results['protLength'] for pos in results['position']
-    ]
-    results['localDisorder'] = [
-        np.mean(
-            iupred3_preds[pos:pos+len(peptide)]
-        ) for pos in results['position']
-    ]
-    # Mostly relevant for frameshift, look for stop codons
-    results['stopDistances'] = [
-        il_prot_seq[start_pos+pep_len:].index('*') if '*' in il_prot_seq[start_pos+pep_len:]
-        else len(il_prot_seq[start_pos+pep_len:])
-        for start_pos in results['position']
-    ]
-    results['fragmentLength'] = []
-    for aa_group in AMINO_ACID_GROUPS:
-        results[f'C_term_neg_1_{aa_group}'] = []
-    results['C_term_neg_1_end'] = []
-    results['C_term_downstream'] = []
-    results['C_term_downstream_2'] = []
-    results['N_term_upstream'] = []
-    results['N_term_upstream_2'] = []
-    prot_splits = prot_seq.split('*')
-    for prot_frag in prot_splits:
-        padded_frag = prot_frag +'XX'
-        if peptide in prot_frag.replace('I', 'L'):
-            for pos in [
-                occ.start() for occ in re.finditer(peptide, prot_frag.replace('I', 'L'))
-            ]:
-                results['fragmentLength'].append(len(prot_frag))
-                results['C_term_downstream'].append(padded_frag[pos+pep_len])
-                results['C_term_downstream_2'].append(padded_frag[pos+pep_len+1])
-                results['N_term_upstream'].append(('X' + padded_frag)[pos])
-                results['N_term_upstream_2'].append(('XX' + padded_frag)[pos])
-                for aa_group, aa_list in AMINO_ACID_GROUPS.items():
-                    results[f'C_term_neg_1_{aa_group}'].append(
-                        int(padded_frag[pos+pep_len] in aa_list)
-                    )
-                results['C_term_neg_1_end'].append(int(padded_frag[pos+pep_len] == 'X'))
-
-    return results
-
-
-def add_features(total_pep_df):
-    """ Add all required training features to the DataFrame.
+def add_features(total_pep_df, codon_index_df=None, protein_features_df=None, n_cores=1):
+    """ Add all required training features to the DataFrame, codon_index_df and
+        protein_features_df are the optional codon index (see ppm.codon_index) and
+        protein level features (see ppm.protein_cache) of the ORFs.
     """
-    # Apply create_features function to compute all required features:
-    total_pep_df = total_pep_df.with_columns(
-        pl.struct(['peptide', 'protSeq', 'rnaSeq', 'iupred3_preds']).map_elements(
-            lambda x : create_features(x['peptide'], x['protSeq'], x['rnaSeq'], x['iupred3_preds'])
-        ).alias('allFeatures')
+    # Compute all required features:
+    total_pep_df = pl.concat(
+        [
+            total_pep_df,
+            create_features_partitioned(
+                total_pep_df, codon_index_df, protein_features_df, n_cores,
+            ),
+        ],
+        how='horizontal',
     )
-    total_pep_df = total_pep_df.unnest('allFeatures')
 
     # Explode in case a peptide mulit-maps within a single ORF.
     total_pep_df = total_pep_df.explode(
@@ -1,20 +1,27 @@
+from math import ceil
 import multiprocessing as mp
 import os
-import re
+import shutil
 import warnings
 
 import numpy as np
 import polars as pl
 
 from ppm.constants import (
-    AMINO_ACIDS,
     ID_COLUMNS,
     SPLICE_SPECIFIC_FEATURES,
 )
 from ppm.preprocess_utils import merge_orf_level_data, get_sampled_negative_peps
+from ppm.protein_cache import read_protein_store, write_protein_store
+from ppm.spliced_feature_engine import create_spliced_features_batched
 
 warnings.filterwarnings('ignore')
 
+# Protein columns held in the shared protein store rather than sent with every task.
+STORED_PROTEIN_COLUMNS = ['protSeq', 'iupred3_preds', 'canonicalStarts']
+# Chunks smaller than this are not worth the overhead of a task.
+MIN_CHUNK_ROWS = 1_000
+
 
 def process_spliced(config):
     """ Function run to process uniquely mapped peptides attributed to each stratum.
@@ -35,7 +42,6 @@ def process_spliced_len(config, pep_len):
     cell_line : str
         The cell line being processed
     """
-    os.environ['POLARS_MAX_THREADS'] = '1'
     if not os.path.exists(f'{config.output_folder}/trainingDatasets/{pep_len}'):
         os.mkdir(f'{config.output_folder}/trainingDatasets/{pep_len}')
 
@@ -86,48 +92,24 @@ def gather_negative_samples(config, pep_len, pos_peps):
     """
     # Collect negative samples from relevant cell line.
     pep_dfs = get_sampled_negative_peps(config, pep_len, False, 'spliced')
-    neg_pep_df = pl.concat(pep_dfs)
-
-    neg_pep_df = neg_pep_df.join(
-        pos_peps.with_columns(pl.lit('flag').alias('uniqueFlag')), how='left', on='peptide'
+    neg_pep_lf = pl.concat(pep_dfs).lazy().join(pos_peps.lazy(), how='anti', on='peptide')
+
+    # The background store holds the mappings as list columns, empty entries are dropped.
+    neg_pep_lf = neg_pep_lf.with_columns(
+        pl.col('isForward').cast(pl.List(pl.Int8)),
+        *[
+            pl.col(column).list.eval(pl.element().filter(pl.element().str.len_chars() > 0))
+            for column in ['sr1', 'splicedProteins']
+        ],
     )
-    neg_pep_df = neg_pep_df.filter(pl.col('uniqueFlag').is_null()).drop('uniqueFlag')
-
+    if config.validate_spliced_background:
+        report_background_consistency(neg_pep_lf)
 
-    neg_pep_df = neg_pep_df.with_columns(
-        pl.col('sr1').str.split(' '),
-        pl.col('interveningSeqLengths').str.split(' ').cast(pl.List(pl.Int64)),
-        pl.col('splicedProteins').str.split(' '),
-        pl.col('sr1_Index').str.split(' ').cast(pl.List(pl.Int64)),
-        pl.col('sr2_Index').str.split(' ').cast(pl.List(pl.Int64)),
-        pl.col('isForward').str.split(' ').cast(pl.List(pl.Int8)),
-    )
-    print(neg_pep_df.filter(
-        pl.col('sr1').list.len().ne(pl.col('interveningSeqLengths').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('splicedProteins').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('sr1_Index').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('sr2_Index').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('isForward').list.len()) 
-    ))
-    neg_pep_df = neg_pep_df.with_columns(
-        pl.col('sr1').map_elements(lambda x : [a for a in x if a], return_dtype=pl.List(pl.String)),
-        pl.col('splicedProteins').map_elements(lambda x : [a for a in x if a], return_dtype=pl.List(pl.String)),
-    )
-    print(neg_pep_df.filter(
-        pl.col('sr1').list.len().ne(pl.col('interveningSeqLengths').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('splicedProteins').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('sr1_Index').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('sr2_Index').list.len()) |
-        pl.col('sr1').list.len().ne(pl.col('isForward').list.len()) 
-    ))
-    print(neg_pep_df)
-    neg_pep_df = neg_pep_df.explode(
+    neg_pep_df = neg_pep_lf.explode(
         SPLICE_SPECIFIC_FEATURES + ['splicedProteins']
-    )
-    neg_pep_df = neg_pep_df.rename({'splicedProteins': 'proteinID'})
-    neg_pep_df = neg_pep_df.unique(subset=[
+    ).rename({'splicedProteins': 'proteinID'}).unique(subset=[
         'peptide', 'proteinID', 'sr1_Index', 'sr2_Index',
-    ])
+    ]).collect()
 
     neg_pep_df = merge_orf_level_data(
         neg_pep_df, config, 'spliced', 0, ID_COLUMNS + SPLICE_SPECIFIC_FEATURES
@@ -136,143 +118,144 @@ def gather_negative_samples(config, pep_len, pos_peps):
     add_features_mp(neg_pep_df, config, 0, pep_len, False)
 
 
-def add_features_mp(pep_df, config, label, pep_len, is_mm):
-    pep_df = pep_df.with_row_count('group').with_columns(
-        pl.col('group')//1_000
+def report_background_consistency(neg_pep_lf):
+    """ Function to report the number of background peptides whose mapping lists differ in
+        length, which cannot be expanded into one row per mapping.
+    """
+    n_mappings = pl.col('sr1').list.len()
+    counts = neg_pep_lf.select(
+        pl.len().alias('nPeptides'),
+        pl.any_horizontal(
+            n_mappings.ne(pl.col(column).list.len())
+            for column in SPLICE_SPECIFIC_FEATURES + ['splicedProteins'] if column != 'sr1'
+        ).sum().alias('nInconsistent'),
+    ).collect()
+    print(
+        f'{counts["nInconsistent"][0]} of {counts["nPeptides"][0]} spliced background '
+        'peptides have mapping lists of different lengths.'
     )
-    pos_pep_dfs = pep_df.partition_by('group')
-    func_args = []
-    for idx, pp_df in enumerate(pos_pep_dfs):
-        func_args.append((pp_df, config.output_folder, pep_len, idx, label, is_mm))
 
-    with mp.get_context('spawn').Pool(processes=20) as pool:
-        pool.starmap(add_spliced_features, func_args)
 
-
-def add_spliced_features(total_pep_df, output_folder, pep_len, idx, label, is_mm=False):
-    """ Add all required training features to the DataFrame.
+def add_features_mp(pep_df, config, label, pep_len, is_mm):
+    """ Function to add features to the spliced peptides in a pool of workers, writing a
+        single parquet per peptide length and label. Rows are split into chunks of similar
+        estimated work (total protein length) and the protein columns are written once to a
+        shared protein store, so each task only carries its peptide rows and protein keys.
     """
-    # Apply create_features function to compute all required features:
-    total_pep_df = total_pep_df.with_columns(
-        pl.struct([
-            'peptide', 'sr1', 'protSeq', 'iupred3_preds',
-            'sr1_Index', 'sr2_Index', 'canonicalPeptides'
-        ]).map_elements(
-            lambda x : create_spliced_features(
-                x['peptide'], x['sr1'], x['protSeq'], x['iupred3_preds'],
-                x['sr1_Index'], x['sr2_Index'], x['canonicalPeptides']
-            )
-        ).alias('allFeatures')
-    )
-    total_pep_df = total_pep_df.unnest('allFeatures')
-
-    total_pep_df = total_pep_df.drop(['iupred3_preds', 'protSeq', 'rnaSeq', 'canonicalPeptides'])
-    if is_mm:
-        total_pep_df.write_parquet(
-            f'{output_folder}/mmDatasets/{pep_len}/df_{label}_{idx}.parquet'
+    dataset_folder = f'{config.output_folder}/{"mmDatasets" if is_mm else "trainingDatasets"}'
+    output_path = f'{dataset_folder}/{pep_len}/df_{label}.parquet'
+    run_name = f'{"mm" if is_mm else "training"}_{pep_len}_{label}'
+    # Remove the output of earlier runs, including the per chunk files of earlier versions,
+    # so that no stale dataset is left if there are no peptides or a worker fails.
+    for file_name in os.listdir(f'{dataset_folder}/{pep_len}'):
+        if file_name == f'df_{label}.parquet' or (
+            file_name.startswith(f'df_{label}_') and file_name.endswith('.parquet')
+        ):
+            os.remove(f'{dataset_folder}/{pep_len}/{file_name}')
+    if not pep_df.shape[0]:
+        return
+
+    store_path = f'{config.output_folder}/proteinStore/{run_name}.arrow'
+    chunk_folder = f'{config.output_folder}/featureChunks/{run_name}'
+    try:
+        write_protein_store(pep_df.select(['proteinID'] + STORED_PROTEIN_COLUMNS), store_path)
+
+        chunk_idxs = get_work_chunks(pep_df, config)
+        pep_df = pep_df.drop(STORED_PROTEIN_COLUMNS + ['rnaSeq', 'canonicalPeptides']).select(
+            pl.Series('group', chunk_idxs, dtype=pl.UInt32), pl.all(),
         )
-    else:
-        total_pep_df.write_parquet(
-            f'{output_folder}/trainingDatasets/{pep_len}/df_{label}_{idx}.parquet'
+        os.makedirs(chunk_folder, exist_ok=True)
+        func_args = [
+            (chunk_df, store_path, f'{chunk_folder}/{idx}.parquet')
+            for idx, chunk_df in enumerate(pep_df.partition_by('group', maintain_order=True))
+        ]
+
+        n_workers = min(config.n_cores, len(func_args))
+        if n_workers > 1:
+            with _spawn_pool(n_workers, max(1, config.n_cores//n_workers)) as pool:
+                pool.starmap(write_spliced_features, func_args)
+        else:
+            for args in func_args:
+                write_spliced_features(*args)
+
+        # Chunks are streamed into one file, in row order.
+        pl.scan_parquet([chunk_path for _, _, chunk_path in func_args]).sink_parquet(
+            f'{output_path}.tmp'
         )
-
-
-def create_spliced_features(peptide, sr1, prot_seq, iupred3_preds, sr1_index, sr2_index, canonical_peptides):
-    """ Function to create features that may be relevant for model training.
+        os.replace(f'{output_path}.tmp', output_path)
+    finally:
+        # The store and chunks are removed even if a worker fails.
+        for temp_path in [store_path, f'{store_path}.tmp', f'{output_path}.tmp']:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+
+
+def get_work_chunks(pep_df, config):
+    """ Function to assign consecutive rows to chunks of similar estimated work, taken as the
+        total length of the rows' proteins. Rows are cut into at least nCores chunks of about
+        config.spliced_chunk_work work, then chunks with fewer than MIN_CHUNK_ROWS rows, as
+        cut next to long proteins, are merged into the chunks after them and a short last
+        chunk into the one before, so only a single chunk can hold fewer rows.
     """
-    sr2 = peptide[len(sr1):]
-    sr1 = prot_seq[sr1_index:sr1_index+len(sr1)]
-    sr2 = prot_seq[sr2_index:sr2_index+len(sr2)]
-    il_prot_seq = prot_seq.replace('I', 'L')
-    results = {}
-    results['protLength'] = len(prot_seq)
-
-    p1_index = (sr1_index + len(sr1)) - 1
-    p2_index = (sr1_index + len(sr1)) - 2
-    p_minus_1_index = sr1_index+len(sr1)
-    p_minus_2_index = p_minus_1_index + 1
-
-    p_prime_2_index = sr2_index+1
-    p_prime_minus_1_index = sr2_index-1
-    p_prime_minus_2_index = p_prime_minus_1_index - 1
-
-    p1_aa = prot_seq[p1_index]
-    if p_minus_1_index < len(prot_seq):
-        p_neg_1_aa = prot_seq[p_minus_1_index]
-    else:
-        p_neg_1_aa = 'X'
-
-    p1_prime_aa = prot_seq[sr2_index]
-    if p_prime_minus_1_index > 0:
-        p_neg_1_prime_aa = prot_seq[p_prime_minus_1_index]
-    else:
-        p_neg_1_prime_aa = 'X'
-    
-    for amino_acid in AMINO_ACIDS:
-        results[f'p1_{amino_acid}'] = int(p1_aa == amino_acid)
-        results[f'p_neg_1_{amino_acid}'] = int(p_neg_1_aa == amino_acid)
-        results[f'p1_prime_{amino_acid}'] = int(p1_prime_aa == amino_acid)
-        results[f'p_neg_1_prime_{amino_acid}'] = int(p_neg_1_prime_aa == amino_acid)
-
-    if p2_index > 0:
-        results['p2'] = prot_seq[p2_index]
-    else:
-        results['p2'] = 'X'
-
-    if p_minus_1_index < len(prot_seq):
-        results['p_minus_1'] = prot_seq[p_minus_1_index]
-    else:
-        results['p_minus_1'] = 'X'
-
-    if p_minus_2_index < len(prot_seq):
-        results['p_minus_2'] = prot_seq[p_minus_2_index]
-    else:
-        results['p_minus_2'] = 'X'
-
-
-    if p_prime_2_index < len(prot_seq):
-        results['p2_prime'] = prot_seq[p_prime_2_index]
-    else:
-        results['p2_prime'] = 'X'
-
-    if p_prime_minus_1_index >= 0:
-        results['p_minus_1_prime'] = prot_seq[p_prime_minus_1_index]
-    else:
-        results['p_minus_1_prime'] = 'X'
-
-    if p_prime_minus_2_index >= 0:
-        results['p_minus_2_prime'] = prot_seq[p_prime_minus_2_index]
-    else:
-        results['p_minus_2_prime'] = 'X'
+    work = pep_df['protSeq'].str.len_bytes().cast(pl.Int64).to_numpy()
+    total_work = max(int(work.sum()), 1)
+    n_chunks = max(1, min(
+        ceil(pep_df.shape[0]/MIN_CHUNK_ROWS),
+        max(config.n_cores, ceil(total_work/config.spliced_chunk_work)),
+    ))
+    chunk_idxs = (np.cumsum(work) - work)*n_chunks//total_work
+
+    merged_idxs = []
+    merged_idx = 0
+    n_rows = 0
+    for n_chunk_rows in np.bincount(chunk_idxs, minlength=n_chunks):
+        merged_idxs.append(merged_idx)
+        n_rows += n_chunk_rows
+        if n_rows >= MIN_CHUNK_ROWS:
+            merged_idx += 1
+            n_rows = 0
+    if n_rows and merged_idx > 0:
+        merged_idxs = [min(idx, merged_idx - 1) for idx in merged_idxs]
+    return np.asarray(merged_idxs)[chunk_idxs]
+
+
+def _spawn_pool(n_workers, n_threads):
+    """ Helper function to start a spawn pool whose workers each use n_threads polars threads,
+        which polars reads from the environment when a worker starts.
+    """
+    polars_max_threads = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = str(n_threads)
+    try:
+        return mp.get_context('spawn').Pool(processes=n_workers)
+    finally:
+        if polars_max_threads is None:
+            del os.environ['POLARS_MAX_THREADS']
+        else:
+            os.environ['POLARS_MAX_THREADS'] = polars_max_threads
+
+
+def write_spliced_features(chunk_df, store_path, chunk_path):
+    """ Function to add features to a chunk of spliced peptides and write it to parquet.
+    """
+    add_spliced_features(chunk_df, store_path).write_parquet(chunk_path)
 
 
+def add_spliced_features(total_pep_df, store_path=None):
+    """ Add all required training features to the DataFrame. If store_path is given the
+        protein columns are joined from that protein store (see ppm.protein_cache).
+    """
+    if store_path is not None:
+        total_pep_df = total_pep_df.join(
+            read_protein_store(store_path), how='left', on='proteinID', maintain_order='left',
+        )
 
-    if not canonical_peptides:
-        results['sr2_can_dist'] = None
-        results['sr1_can_dist'] = None
-    else:
-        start_of_peps = []
-        for peptide in canonical_peptides:
-            start_of_peps.extend([
-                occ.start() for occ in re.finditer(peptide, il_prot_seq) 
-            ])
-        results['sr1_can_dist'] = min([
-            abs(sr1_index-pep_start) for pep_start in start_of_peps
-        ])
-        results['sr2_can_dist'] = min([
-            abs(sr2_index-pep_start) for pep_start in start_of_peps
-        ])
-
-    for a_a in AMINO_ACIDS:
-        results[f'{a_a}_p1'] = int(sr1[-1] == a_a)
-        results[f'{a_a}_p1_prime'] = int(sr2[0] == a_a)
-
-
-    results['sr1_localDisorder'] = np.mean(
-        iupred3_preds[sr1_index:sr1_index+len(sr1)]
-    ) 
-    results['sr2_localDisorder'] = np.mean(
-        iupred3_preds[sr2_index:sr2_index+len(sr1)]
+    # Compute all required features:
+    total_pep_df = pl.concat(
+        [total_pep_df, create_spliced_features_batched(total_pep_df)], how='horizontal',
     )
 
-    return results
+    return total_pep_df.drop(
+        ['iupred3_preds', 'protSeq', 'rnaSeq', 'canonicalPeptides', 'canonicalStarts'],
+        strict=False,
+    )
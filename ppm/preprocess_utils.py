@@ -6,48 +6,58 @@ import os
 import numpy as np
 import polars as pl
 
+from ppm.background_store import (
+    get_background_path, scan_background, split_background_lists,
+)
 from ppm.constants import (
     COMMON_FEATURES,
     TRANSCRIPT_FEATURES,
     SPLICE_SPECIFIC_FEATURES,
+    PROTEOMICS_FEATURES,
     STRATUM_SPECIFIC_FEATURES,
 )
+from ppm.protein_cache import read_canonical_peptides, read_proteomics
 np.random.seed(42)
 
 
 def merge_orf_level_data(pep_df, config, stratum, label, id_columns):
-    """ Function to merge in data from the reading frame level
+    """ Function to merge in data from the reading frame level. Only the proteins of pep_df
+        and the columns used are read from the antigen parquet.
     """
     if stratum == 'spliced':
-        prot_df = pl.read_parquet(f'{config.antigen_folder}/canonical.parquet')
-        final_can_id_df = pl.read_csv(
-            f'{config.canonical_results}/unique_peps_scored.csv',
-            columns=['peptide', 'proteinID', 'label']
-        )
-        final_can_id_df = final_can_id_df.filter(pl.col('label').eq(1))
-        final_can_id_df = final_can_id_df.group_by('proteinID').agg(
-            pl.col('peptide').n_unique().alias('nCanonicalPeptides'),
-            pl.col('peptide').alias('canonicalPeptides'),
-        )
-        prot_df = prot_df.join(final_can_id_df, how='left', on=['proteinID'])
-        prot_df = prot_df.with_columns(pl.col('nCanonicalPeptides').fill_null(0))
         pep_df = pep_df.select(['peptide', 'proteinID'] + SPLICE_SPECIFIC_FEATURES)
+        antigen_stratum = 'canonical'
     else:
-        prot_df = pl.read_parquet(f'{config.antigen_folder}/{stratum}.parquet')
         pep_df = pep_df.select(['peptide', 'proteinID'])
+        antigen_stratum = stratum
+
+    prot_lf = pl.scan_parquet(f'{config.antigen_folder}/{antigen_stratum}.parquet').join(
+        pep_df.lazy().select('proteinID').unique(), how='semi', on='proteinID',
+    )
+    if stratum == 'spliced':
+        prot_lf = prot_lf.join(
+            read_canonical_peptides(config.antigen_folder, config.canonical_results).lazy(),
+            how='left', on=['proteinID'],
+        )
+        prot_lf = prot_lf.with_columns(pl.col('nCanonicalPeptides').fill_null(0))
     if stratum == 'intergenic': #TODO
-        prot_df = prot_df.with_columns(
+        prot_lf = prot_lf.with_columns(
             *[pl.lit(None).alias(feature) for feature in TRANSCRIPT_FEATURES[config.cell_line]]
         )
 
+    stratum_features = STRATUM_SPECIFIC_FEATURES[stratum]
+    if stratum == 'spliced':
+        # Sorted start positions of each protein's canonical peptides, for distance features.
+        stratum_features = stratum_features + ['canonicalStarts']
     select_features = (
         COMMON_FEATURES +
         TRANSCRIPT_FEATURES[config.cell_line] +
-        STRATUM_SPECIFIC_FEATURES[stratum]
+        stratum_features
     )
 
     pep_df = pep_df.join(
-        prot_df.select(select_features), how='inner', on='proteinID',
+        prot_lf.select(select_features).collect(), how='inner', on='proteinID',
+        maintain_order='left',
     )
     pep_df = pep_df.with_columns(
         pl.lit(label).alias('label')
@@ -58,83 +68,171 @@ def merge_orf_level_data(pep_df, config, stratum, label, id_columns):
             'protSeq', 'label',
             'rnaSeq', 'iupred3_preds', 'proteinHydrophobicity'
         ] + TRANSCRIPT_FEATURES[config.cell_line]
-        + STRATUM_SPECIFIC_FEATURES[stratum]
+        + stratum_features
     )
 
     pep_df = pep_df.select(final_columns)
 
     if 'geneID' in pep_df.columns:
-        gene_df = pl.read_parquet(f'{config.antigen_folder}/gene.parquet')
-        if config.cell_line == 'K562':
-            pep_df = pep_df.join(
-                gene_df.select(['geneID', 'proteomics_K562']),
-                how='left',
-                on='geneID'
-            )
-            pep_df = pep_df.with_columns(pl.col('proteomics_K562').fill_null(0))
-        else:
-            pep_df = pep_df.join(
-                gene_df.select(['geneID', 'proteomics_B721']),
-                how='left',
-                on='geneID'
-            )
-            pep_df = pep_df.with_columns(pl.col('proteomics_B721').fill_null(0))
-        print(pep_df.filter(pl.col('proteinID').eq('ENSP00000462667.1')))
+        pep_df = pep_df.join(
+            read_proteomics(config.antigen_folder, config.cell_line),
+            how='left',
+            on='geneID'
+        )
+        pep_df = pep_df.with_columns(
+            pl.col(PROTEOMICS_FEATURES[config.cell_line]).fill_null(0)
+        )
     return pep_df
 
-def get_sampled_negative_peps(config, pep_len, is_cryptic, stratum):
-    pep_dfs = []
-    sample_df = pl.read_csv(f'{config.background_folder}/sample_ratios/ratio_{pep_len}.csv')
-    sample_vals = dict(zip(sample_df['dataset'].to_list(), sample_df['fraction'].to_list()))
+def get_sampled_negative_peps(config, pep_len, is_cryptic, stratum, draws=None):
+    sample_vals = read_sample_ratios(config, pep_len)
+    pep_dfs = load_background(config, pep_len, is_cryptic, stratum)
+    min_count = get_min_sampled_count(pep_dfs.items(), sample_vals)
+
+    return sample_negative_peps(
+        pep_dfs.items(), sample_vals, min_count, stratum,
+        iter(np.random.random, None) if draws is None else iter(draws),
+    )
 
-    min_count = get_min_counts(config, pep_len, stratum, is_cryptic, sample_vals)
 
+def load_background(config, pep_len, is_cryptic, stratum):
+    """ Function to load the background peptides of a stratum from every dataset of the cell
+        line, read once and shared between computing the minimum count and sampling.
+    """
+    pep_dfs = {}
     for dataset in os.listdir(f'{config.background_folder}/remapped/{pep_len}'):
         if _check_dataset(dataset, config.cell_line):
+            if get_background_path(
+                f'{config.background_folder}/remapped/{pep_len}/{dataset}', 'peptides'
+            ) is None:
+                print(f'Missing for {dataset}, length {pep_len}')
+                continue
+
             try:
-                pep_df = _get_pep_df(config, is_cryptic, pep_len, dataset, stratum)
+                pep_dfs[dataset] = _get_pep_df(config, is_cryptic, pep_len, dataset, stratum)
             except:
                 print(f'Failure for {dataset}, length {pep_len}')
-                continue
-            sample_goal = min_count*sample_vals[dataset]
-            if stratum == 'spliced':
-                sample_goal /= 100
-            sample_goal_frac = sample_goal - floor(sample_goal)
-            if np.random.random() > sample_goal_frac:
-                sample_goal = ceil(sample_goal)
-            else:
-                sample_goal = floor(sample_goal)
+    return pep_dfs
 
-            if pep_df.shape[0] and pep_df.shape[0] > sample_goal:
-                pep_df = pep_df.sample(n=sample_goal, seed=1)
 
-            if pep_df.shape[0]:
-                pep_dfs.append(pep_df)
+def read_sample_ratios(config, pep_len):
+    """ Function to read the fraction of background peptides to sample from each dataset.
+    """
+    sample_df = pl.read_csv(f'{config.background_folder}/sample_ratios/ratio_{pep_len}.csv')
+    return dict(zip(sample_df['dataset'].to_list(), sample_df['fraction'].to_list()))
 
-    return pep_dfs
+
+def sample_negative_peps(pep_dfs, sample_vals, min_count, stratum, draws):
+    """ Function to sample background peptides from each dataset in proportion to its sample
+        ratio, pep_dfs yields dataset and DataFrame pairs and draws yields one uniform random
+        number per dataset used to round the sample goal.
+    """
+    sampled_dfs = []
+    for dataset, pep_df in pep_dfs:
+        sample_goal = min_count*sample_vals[dataset]
+        if stratum == 'spliced':
+            sample_goal /= 100
+        sample_goal_frac = sample_goal - floor(sample_goal)
+        if next(draws) > sample_goal_frac:
+            sample_goal = ceil(sample_goal)
+        else:
+            sample_goal = floor(sample_goal)
+
+        if pep_df.shape[0] and pep_df.shape[0] > sample_goal:
+            pep_df = pep_df.sample(n=sample_goal, seed=1)
+
+        if pep_df.shape[0]:
+            sampled_dfs.append(pep_df)
+
+    return sampled_dfs
 
 def get_min_counts(config, pep_len, stratum, is_cryptic, sample_vals):
-    sampled_min_count = 1_000_000_000
-    for dataset in os.listdir(f'{config.background_folder}/remapped/{pep_len}'):
-        if _check_dataset(dataset, config.cell_line):
-            if not os.path.exists(f'{config.background_folder}/remapped/{pep_len}/{dataset}/peptides.csv'):
-                print(f'Missing for {dataset}, length {pep_len}')
-                continue
+    return get_min_sampled_count(
+        load_background(config, pep_len, is_cryptic, stratum).items(), sample_vals,
+    )
 
-            try:
-                pep_df = _get_pep_df(config, is_cryptic, pep_len, dataset, stratum)
-            except:
-                print(f'Failure for {dataset}, length {pep_len}')
-                continue
-            pep_count = pep_df.shape[0]/sample_vals[dataset]
-            if pep_count and pep_count < sampled_min_count:
-                sampled_min_count = pep_count
+
+def get_min_sampled_count(pep_dfs, sample_vals):
+    """ Function to get the smallest dataset size after scaling by its sample ratio.
+    """
+    sampled_min_count = 1_000_000_000
+    for dataset, pep_df in pep_dfs:
+        pep_count = pep_df.shape[0]/sample_vals[dataset]
+        if pep_count and pep_count < sampled_min_count:
+            sampled_min_count = pep_count
 
     if sampled_min_count == 1_000_000_000:
         return 0
     return sampled_min_count
 
 
+def read_background(config, pep_len, is_cryptic, strata):
+    """ Function to read every background dataset of a peptide length once, returning the
+        background peptides of each stratum by dataset. The strata are filtered from a
+        single lazy query per dataset.
+    """
+    background = {stratum: {} for stratum in strata}
+    for dataset in _list_background_datasets(config, pep_len, is_cryptic, strata):
+        dataset_folder = f'{config.background_folder}/remapped/{pep_len}/{dataset}'
+        cached_dfs = [
+            _read_cached_pep_df(config, dataset_folder, is_cryptic, stratum) for stratum in strata
+        ]
+        if all(pep_df is not None for pep_df in cached_dfs):
+            for stratum, pep_df in zip(strata, cached_dfs):
+                background[stratum][dataset] = pep_df
+            continue
+        try:
+            pep_lf = scan_background(dataset_folder, 'peptides')
+            det_lfs = {
+                details: scan_background(dataset_folder, f'details/{details}')
+                for details in {_get_details_name(is_cryptic, stratum) for stratum in strata}
+            }
+            pep_dfs = pl.collect_all([
+                _filter_pep_df(
+                    pep_lf, det_lfs[_get_details_name(is_cryptic, stratum)], stratum,
+                ) for stratum in strata
+            ])
+        except:
+            print(f'Failure for {dataset}, length {pep_len}')
+            continue
+        for stratum, pep_df in zip(strata, pep_dfs):
+            _write_cached_pep_df(config, dataset_folder, stratum, pep_df)
+            background[stratum][dataset] = pep_df
+    return background
+
+
+def get_sampling_draws(config, pep_lens, is_cryptic, strata):
+    """ Function to draw the random numbers used to round sample goals for every stratum and
+        peptide length, in the order that processing one stratum and length at a time uses
+        them, so that sampling matches it.
+    """
+    draws = {}
+    for stratum in strata:
+        for pep_len in pep_lens:
+            draws[(stratum, pep_len)] = np.random.random(
+                len(_list_background_datasets(config, pep_len, is_cryptic, [stratum]))
+            )
+    return draws
+
+
+def _list_background_datasets(config, pep_len, is_cryptic, strata):
+    """ Helper function to list the background datasets of the cell line with remapped
+        peptides and details for the strata.
+    """
+    datasets = []
+    for dataset in os.listdir(f'{config.background_folder}/remapped/{pep_len}'):
+        dataset_folder = f'{config.background_folder}/remapped/{pep_len}/{dataset}'
+        if _check_dataset(dataset, config.cell_line) and get_background_path(
+            dataset_folder, 'peptides'
+        ) is not None and all(
+            get_background_path(
+                dataset_folder, f'details/{_get_details_name(is_cryptic, stratum)}'
+            ) is not None for stratum in strata
+        ):
+            datasets.append(dataset)
+    return datasets
+
+
 def _check_dataset(dataset, cell_line):
     """ Helper function to check if a dataset if for the K562 or B721.221 cell line.
     """
@@ -146,25 +244,73 @@ def _check_dataset(dataset, cell_line):
         raise ValueError(f'Unknown cell line {cell_line}')
     
 
-def _get_pep_df(config, is_cryptic, pep_len, dataset, stratum):
-    pep_df = pl.read_csv(f'{config.background_folder}/remapped/{pep_len}/{dataset}/peptides.csv')
+def _get_details_name(is_cryptic, stratum):
+    """ Helper function to get the name of the details file holding a stratum's mappings.
+    """
     if is_cryptic:
-        det_df = pl.read_csv(f'{config.background_folder}/remapped/{pep_len}/{dataset}/details/cryptic.csv')
-    else:
-        det_df = pl.read_csv(f'{config.background_folder}/remapped/{pep_len}/{dataset}/details/{stratum}.csv')
+        return 'cryptic'
+    return stratum
 
-    pep_df = pep_df.unique('peptide')
-    det_df = det_df.unique('peptide')
 
+def _get_pep_df(config, is_cryptic, pep_len, dataset, stratum):
+    dataset_folder = f'{config.background_folder}/remapped/{pep_len}/{dataset}'
+    pep_df = _read_cached_pep_df(config, dataset_folder, is_cryptic, stratum)
+    if pep_df is not None:
+        return pep_df
+
+    pep_df = _filter_pep_df(
+        scan_background(dataset_folder, 'peptides'),
+        scan_background(dataset_folder, f'details/{_get_details_name(is_cryptic, stratum)}'),
+        stratum,
+    ).collect()
+    _write_cached_pep_df(config, dataset_folder, stratum, pep_df)
+    return pep_df
+
+
+def _read_cached_pep_df(config, dataset_folder, is_cryptic, stratum):
+    """ Helper function to read the cached background peptides of a stratum if caching is on
+        and the cache is newer than the background store it was built from, otherwise None.
+    """
+    cache_path = f'{dataset_folder}/background_{stratum}.parquet'
+    if not config.background_cache or not os.path.exists(cache_path):
+        return None
+    source_paths = [
+        get_background_path(dataset_folder, 'peptides'),
+        get_background_path(dataset_folder, f'details/{_get_details_name(is_cryptic, stratum)}'),
+    ]
+    if any(
+        source_path is None or
+        os.path.getmtime(source_path) > os.path.getmtime(cache_path)
+        for source_path in source_paths
+    ):
+        return None
+    # Caches written before the parquet store hold space separated strings.
+    return split_background_lists(pl.read_parquet(cache_path))
+
+
+def _write_cached_pep_df(config, dataset_folder, stratum, pep_df):
+    """ Helper function to cache the background peptides of a stratum as parquet.
+    """
+    if config.background_cache:
+        cache_path = f'{dataset_folder}/background_{stratum}.parquet'
+        pep_df.write_parquet(f'{cache_path}.tmp')
+        os.replace(f'{cache_path}.tmp', cache_path)
+
+
+def _filter_pep_df(pep_lf, det_lf, stratum):
+    """ Helper function to filter deduplicated background peptides to those of a stratum and
+        join their mapping details. On the parquet store the filters and the columns used are
+        pushed down into the scans.
+    """
     if stratum == 'spliced':
-        pep_df = pep_df.filter(pl.col(f'nCrypticProteins').eq(0) & pl.col(f'nSplicedProteins').gt(0) )
-        det_df = det_df.with_columns(
-            pl.col('sr1').fill_null('NA')
+        pep_lf = pep_lf.filter(pl.col(f'nCrypticProteins').eq(0) & pl.col(f'nSplicedProteins').gt(0) )
+        det_lf = det_lf.with_columns(
+            pl.col('sr1').fill_null(pl.lit(['NA']))
         )
     else:
-        pep_df = pep_df.filter(pl.col(f'{stratum}_nProteins').gt(0) & pl.col(f'nSplicedProteins').eq(0))
-    pep_df = pep_df.filter(
+        pep_lf = pep_lf.filter(pl.col(f'{stratum}_nProteins').gt(0) & pl.col(f'nSplicedProteins').eq(0))
+    pep_lf = pep_lf.filter(
         pl.col('fusion_nProteins').eq(0) & pl.col('mutation_nProteins').eq(0) &
         pl.col('TrEMBL_nProteins').eq(0)
     )
-    return pep_df.select(['peptide']).join(det_df, how='inner', on='peptide')
+    return pep_lf.select(['peptide']).join(det_lf, how='inner', on='peptide')
@@ -0,0 +1,160 @@
+""" Functions to cache antigen data and protein level features in memory, and optionally on
+    disk, so that they are derived once per protein rather than for every stratum, peptide
+    length and peptide row.
+"""
+from functools import lru_cache
+import hashlib
+import os
+
+import polars as pl
+
+from ppm.constants import PROTEOMICS_FEATURES
+from ppm.peptide_locator import locate_peptides
+
+# Number of antigen tables and protein feature tables held in memory.
+PROTEIN_CACHE_SIZE = 4
+PROTEIN_FEATURE_COLUMNS = ['protLength'] + [f'{nucleotide}_frac' for nucleotide in 'AUGC']
+
+
+@lru_cache(maxsize=PROTEIN_CACHE_SIZE)
+def read_proteomics(antigen_folder, cell_line):
+    """ Function to read the proteomics of each gene for a cell line, reused between calls.
+    """
+    return pl.read_parquet(
+        f'{antigen_folder}/gene.parquet', columns=['geneID'] + PROTEOMICS_FEATURES[cell_line],
+    )
+
+
+@lru_cache(maxsize=PROTEIN_CACHE_SIZE)
+def read_canonical_peptides(antigen_folder, canonical_results):
+    """ Function to read the peptides assigned to each protein by the canonical model, with
+        the sorted start positions of those peptides within the protein, reused between calls.
+    """
+    can_df = pl.scan_csv(f'{canonical_results}/unique_peps_scored.csv').select(
+        ['peptide', 'proteinID', 'label']
+    ).filter(pl.col('label').eq(1)).group_by('proteinID').agg(
+        pl.col('peptide').n_unique().alias('nCanonicalPeptides'),
+        pl.col('peptide').alias('canonicalPeptides'),
+    ).collect()
+    prot_df = pl.scan_parquet(f'{antigen_folder}/canonical.parquet').select(
+        ['proteinID', 'protSeq']
+    ).join(can_df.lazy(), how='inner', on='proteinID').collect()
+    return can_df.join(get_canonical_starts(prot_df), how='left', on='proteinID')
+
+
+def get_canonical_starts(prot_df):
+    """ Function to get the sorted start positions of all canonical peptides within each
+        protein of a DataFrame with proteinID, protSeq and canonicalPeptides columns.
+    """
+    prot_df = prot_df.select(
+        ['proteinID', 'protSeq', 'canonicalPeptides']
+    ).unique(subset='proteinID', maintain_order=True)
+    canonical_starts = []
+    for prot_seq, canonical_peptides in zip(
+        prot_df['protSeq'].to_list(), prot_df['canonicalPeptides'].to_list(),
+    ):
+        if not canonical_peptides:
+            canonical_starts.append(None)
+            continue
+        canonical_starts.append(sorted(
+            position
+            for positions in locate_peptides(canonical_peptides, prot_seq.replace('I', 'L'))
+            for position in positions
+        ))
+    return prot_df.select('proteinID').with_columns(
+        pl.Series('canonicalStarts', canonical_starts, dtype=pl.List(pl.Int64))
+    )
+
+
+def write_protein_store(prot_df, store_path):
+    """ Function to write protein columns, one row per proteinID, as an uncompressed Arrow
+        IPC file which worker processes memory map rather than receiving the proteins with
+        every task.
+    """
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    prot_df.unique(subset='proteinID', maintain_order=True).write_ipc(
+        f'{store_path}.tmp', compression='uncompressed',
+    )
+    os.replace(f'{store_path}.tmp', store_path)
+
+
+def read_protein_store(store_path):
+    """ Function to memory map a protein store written by write_protein_store, reused
+        between calls while the file is unchanged.
+    """
+    return _read_protein_store(store_path, os.path.getmtime(store_path))
+
+
+@lru_cache(maxsize=PROTEIN_CACHE_SIZE)
+def _read_protein_store(store_path, modified_time):
+    """ Helper function to memory map the protein store, reused between calls.
+    """
+    return pl.read_ipc(store_path, memory_map=True)
+
+
+def get_protein_features(config, stratum):
+    """ Function to get the protein level features of all ORFs of a stratum. If
+        config.protein_feature_cache is set the features are also stored on disk keyed by
+        proteinID and sequence hash, and only new or changed proteins are recomputed.
+    """
+    cache_path = None
+    if config.protein_feature_cache:
+        cache_path = f'{config.output_folder}/proteinFeatures/{stratum}.parquet'
+    return _get_protein_features(config.antigen_folder, stratum, cache_path)
+
+
+@lru_cache(maxsize=PROTEIN_CACHE_SIZE)
+def _get_protein_features(antigen_folder, stratum, cache_path):
+    """ Helper function to get the protein features, reused between calls.
+    """
+    # Only the sequences are read, the cached features hold no other antigen columns.
+    prot_df = pl.read_parquet(
+        f'{antigen_folder}/{stratum}.parquet', columns=['proteinID', 'protSeq', 'rnaSeq'],
+    ).unique(subset='proteinID', maintain_order=True)
+    prot_df = prot_df.with_columns(
+        pl.Series(
+            'seqHash',
+            [
+                hashlib.md5(f'{prot_seq}|{rna_seq}'.encode()).hexdigest()
+                for prot_seq, rna_seq in zip(prot_df['protSeq'], prot_df['rnaSeq'])
+            ],
+            dtype=pl.String,
+        )
+    )
+    if cache_path is None:
+        return compute_protein_features(prot_df).drop('seqHash')
+
+    cached_df = None
+    if os.path.exists(cache_path):
+        cached_df = pl.read_parquet(cache_path).join(
+            prot_df.select(['proteinID', 'seqHash']), how='semi', on=['proteinID', 'seqHash'],
+        )
+        prot_df = prot_df.join(cached_df, how='anti', on=['proteinID', 'seqHash'])
+
+    if cached_df is None or prot_df.shape[0]:
+        features_df = compute_protein_features(prot_df)
+        if cached_df is not None:
+            features_df = pl.concat([cached_df, features_df])
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Temporary files are named per process, as parallel jobs may write the same cache.
+        features_df.write_parquet(f'{cache_path}.{os.getpid()}.tmp')
+        os.replace(f'{cache_path}.{os.getpid()}.tmp', cache_path)
+    else:
+        features_df = cached_df
+    return features_df.drop('seqHash')
+
+
+def compute_protein_features(prot_df):
+    """ Function to compute the protein level features from a DataFrame with proteinID,
+        protSeq and rnaSeq columns, one row per protein.
+    """
+    return prot_df.select(
+        pl.exclude(['protSeq', 'rnaSeq']),
+        pl.col('protSeq').str.len_chars().cast(pl.Int64).alias('protLength'),
+        *[
+            (
+                pl.col('rnaSeq').str.count_matches(nucleotide, literal=True) /
+                pl.col('rnaSeq').str.len_chars()
+            ).alias(f'{nucleotide}_frac') for nucleotide in 'AUGC'
+        ],
+    )
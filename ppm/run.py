@@ -2,6 +2,7 @@
 """
 from argparse import ArgumentParser
 
+from ppm.background_store import convert_background_store
 from ppm.config import Config
 from ppm.create_background import create_bg
 from ppm.create_pisces_db import create_pisces_db
@@ -16,6 +17,7 @@ from ppm.train_spliced import train_spliced_models
 PPM_PIPELINES = [
     'createPiscesDB',
     'bg',
+    'convertBg',
     'all',
     'preprocess',
     'train', 'train+',
@@ -73,6 +75,9 @@ def run_ppm(pipeline=None, config_file=None):
     if pipeline == 'bg':
         create_bg(config, args.pep_length)
 
+    if pipeline == 'convertBg':
+        convert_background_store(config)
+
     if pipeline in ('preprocess', 'all'):
         print(f'Running preprocessing for model {config.model}')
         if config.model == 'cryptic':
@@ -14,7 +14,9 @@ from ppm.constants import (
     SPLICED_FEATURES,
     TRANSCRIPT_FEATURES
 )
+from ppm.codon_index import get_codon_index
 from ppm.preprocess import gather_positive_samples, add_features
+from ppm.protein_cache import get_protein_features
 from ppm.preprocess_spliced import gather_positive_samples_spliced
 
 def score_multi_mappers(config):
@@ -90,7 +92,9 @@ def preprocess_cryptic_multi_mappers(config, pep_len):
             continue
 
         # Additional features for cryptic and canonical peptides.
-        pos_pep_df = add_features(pos_pep_df)
+        pos_pep_df = add_features(
+            pos_pep_df, get_codon_index(config, stratum), get_protein_features(config, stratum),
+        )
         pos_pep_df = pos_pep_df.with_columns(
             pl.lit(CRYPTIC_STRATA.index(stratum)).alias('stratum')
         )
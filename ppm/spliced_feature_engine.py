@@ -0,0 +1,198 @@
+""" Batched computation of the spliced training features, with the residue lookups at the
+    splice sites gathered from an encoded protein buffer for all rows at once.
+"""
+import numpy as np
+import polars as pl
+
+from ppm.constants import AMINO_ACIDS
+
+SITE_FEATURES = [
+    'p2', 'p_minus_1', 'p_minus_2', 'p2_prime', 'p_minus_1_prime', 'p_minus_2_prime',
+]
+SPLICED_FEATURE_SCHEMA = {
+    'protLength': pl.Int64,
+    **{
+        f'{site}_{amino_acid}': pl.Int64
+        for amino_acid in AMINO_ACIDS
+        for site in ['p1', 'p_neg_1', 'p1_prime', 'p_neg_1_prime']
+    },
+    **{feature: pl.String for feature in SITE_FEATURES},
+    'sr1_can_dist': pl.Int64,
+    'sr2_can_dist': pl.Int64,
+    **{
+        f'{amino_acid}_{site}': pl.Int64
+        for amino_acid in AMINO_ACIDS
+        for site in ['p1', 'p1_prime']
+    },
+    'sr1_localDisorder': pl.Float64,
+    'sr2_localDisorder': pl.Float64,
+}
+
+
+def create_spliced_features_batched(total_pep_df):
+    """ Function to create the spliced training features for all rows of a
+        DataFrame with peptide, sr1, proteinID, protSeq, iupred3_preds, sr1_Index, sr2_Index
+        and canonicalStarts columns, the sorted canonical peptide starts of each protein.
+    """
+    prot_df = total_pep_df.select(
+        ['proteinID', 'protSeq', 'iupred3_preds', 'canonicalStarts']
+    ).unique(
+        subset='proteinID', maintain_order=True,
+    ).with_row_index('protIdx')
+    prot_idx = total_pep_df.select('proteinID').join(
+        prot_df.select(['proteinID', 'protIdx']), how='left', on='proteinID',
+        maintain_order='left',
+    )['protIdx'].to_numpy()
+
+    # Proteins and disorder predictions are concatenated, each row indexes its protein.
+    prot_bytes = np.frombuffer(''.join(prot_df['protSeq'].to_list()).encode('ascii'), np.uint8)
+    prot_lens = prot_df['protSeq'].str.len_bytes().cast(pl.Int64).to_numpy()
+    prot_starts = _get_offsets(prot_lens)[prot_idx]
+    prot_lens = prot_lens[prot_idx]
+    disorder = prot_df.filter(pl.col('iupred3_preds').list.len() > 0)['iupred3_preds'].explode()
+    disorder_lens = prot_df['iupred3_preds'].list.len().cast(pl.Int64).to_numpy()
+    disorder_starts = _get_offsets(disorder_lens)[prot_idx]
+    disorder_lens = disorder_lens[prot_idx]
+    disorder = disorder.cast(pl.Float64).to_numpy()
+
+    sr1_idxs = total_pep_df['sr1_Index'].cast(pl.Int64).to_numpy()
+    sr2_idxs = total_pep_df['sr2_Index'].cast(pl.Int64).to_numpy()
+    sr1_lens = total_pep_df['sr1'].str.len_chars().cast(pl.Int64).to_numpy()
+    sr2_lens = np.maximum(
+        total_pep_df['peptide'].str.len_chars().cast(pl.Int64).to_numpy() - sr1_lens, 0
+    )
+
+    # Splice reactants are taken from the protein, truncated at its end.
+    sr1_lens = _slice_lengths(sr1_idxs, sr1_lens, prot_lens)
+    sr2_lens = _slice_lengths(sr2_idxs, sr2_lens, prot_lens)
+    if not (sr1_lens.all() and sr2_lens.all()):
+        raise IndexError('Splice reactant outside of the protein sequence.')
+
+    p1_idxs = sr1_idxs + sr1_lens - 1
+    p_minus_1_idxs = sr1_idxs + sr1_lens
+    sites = {
+        'p1': _residues_at(prot_bytes, prot_starts, prot_lens, p1_idxs),
+        'p_neg_1': _guarded_residues(
+            prot_bytes, prot_starts, prot_lens, p_minus_1_idxs, p_minus_1_idxs < prot_lens,
+        ),
+        'p1_prime': _residues_at(prot_bytes, prot_starts, prot_lens, sr2_idxs),
+        'p_neg_1_prime': _guarded_residues(
+            prot_bytes, prot_starts, prot_lens, sr2_idxs - 1, sr2_idxs - 1 > 0,
+        ),
+    }
+    features = {'protLength': prot_lens}
+    for amino_acid in AMINO_ACIDS:
+        for site, residues in sites.items():
+            features[f'{site}_{amino_acid}'] = (residues == ord(amino_acid)).astype(np.int64)
+
+    for feature, site_idxs, is_valid in [
+        ('p2', p1_idxs - 1, p1_idxs - 1 > 0),
+        ('p_minus_1', p_minus_1_idxs, p_minus_1_idxs < prot_lens),
+        ('p_minus_2', p_minus_1_idxs + 1, p_minus_1_idxs + 1 < prot_lens),
+        ('p2_prime', sr2_idxs + 1, sr2_idxs + 1 < prot_lens),
+        ('p_minus_1_prime', sr2_idxs - 1, sr2_idxs - 1 >= 0),
+        ('p_minus_2_prime', sr2_idxs - 2, sr2_idxs - 2 >= 0),
+    ]:
+        features[feature] = _guarded_residues(
+            prot_bytes, prot_starts, prot_lens, site_idxs, is_valid,
+        ).view('S1').astype(str)
+
+    features['sr1_can_dist'], features['sr2_can_dist'] = _get_canonical_distances(
+        prot_df['canonicalStarts'], prot_idx, sr1_idxs, sr2_idxs,
+    )
+
+    # The last residue of sr1 and the first of sr2 are the p1 and p1 prime residues.
+    for amino_acid in AMINO_ACIDS:
+        features[f'{amino_acid}_p1'] = features[f'p1_{amino_acid}']
+        features[f'{amino_acid}_p1_prime'] = features[f'p1_prime_{amino_acid}']
+
+    # Both disorder windows take the length of sr1.
+    features['sr1_localDisorder'] = _get_window_means(
+        disorder, disorder_starts, disorder_lens, sr1_idxs, sr1_lens,
+    )
+    features['sr2_localDisorder'] = _get_window_means(
+        disorder, disorder_starts, disorder_lens, sr2_idxs, sr1_lens,
+    )
+    return pl.DataFrame(
+        {feature: features[feature] for feature in SPLICED_FEATURE_SCHEMA},
+        schema=SPLICED_FEATURE_SCHEMA,
+    )
+
+
+def _get_offsets(lengths):
+    """ Helper function to get the start of each entry in a concatenation.
+    """
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    return offsets
+
+
+def _slice_lengths(starts, lengths, seq_lens):
+    """ Helper function to get the lengths of the slices seq[start:start+length].
+    """
+    return np.maximum(
+        np.minimum(starts + lengths, seq_lens) - np.minimum(starts, seq_lens), 0
+    )
+
+
+def _residues_at(prot_bytes, prot_starts, prot_lens, indices):
+    """ Helper function to get the residue code at an index of each row's protein, with
+        negative indices counted from the end of the protein as for a Python string.
+    """
+    if ((indices >= prot_lens) | (indices < -prot_lens)).any():
+        raise IndexError('Residue index outside of the protein sequence.')
+    return prot_bytes[prot_starts + np.where(indices < 0, indices + prot_lens, indices)]
+
+
+def _guarded_residues(prot_bytes, prot_starts, prot_lens, indices, is_valid):
+    """ Helper function to get the residue codes at indices, X where the index is not valid.
+    """
+    residues = np.full(len(indices), ord('X'), dtype=np.uint8)
+    residues[is_valid] = _residues_at(
+        prot_bytes, prot_starts[is_valid], prot_lens[is_valid], indices[is_valid],
+    )
+    return residues
+
+
+def _get_canonical_distances(canonical_starts, prot_idx, sr1_idxs, sr2_idxs):
+    """ Helper function to get the distance from each splice reactant to the nearest
+        canonical peptide start of its protein, None if the protein has no canonical peptides.
+        The sorted starts of all proteins are offset into a single increasing array, so the
+        nearest start is found with one binary search for all rows.
+    """
+    n_starts = canonical_starts.list.len().fill_null(0).cast(pl.Int64).to_numpy()
+    flat_starts = canonical_starts.filter(pl.Series(n_starts > 0)).explode().to_numpy()
+    offsets = _get_offsets(n_starts)
+    stride = int(flat_starts.max()) + 1 if len(flat_starts) else 1
+    flat_keys = np.repeat(np.arange(len(n_starts), dtype=np.int64)*stride, n_starts) + flat_starts
+
+    seg_starts, seg_ends = offsets[prot_idx], offsets[prot_idx] + n_starts[prot_idx]
+    has_starts = seg_ends > seg_starts
+    distances = []
+    for sr_idxs in (sr1_idxs, sr2_idxs):
+        # Reactants past the last start are clipped so their keys stay within the protein.
+        sr_keys = prot_idx*stride + np.clip(sr_idxs, 0, stride - 1)
+        right = np.searchsorted(flat_keys, sr_keys)
+        left = right - 1
+        sr_distances = np.full(len(sr_idxs), np.iinfo(np.int64).max, dtype=np.int64)
+        for neighbour in (left, right):
+            is_valid = (neighbour >= seg_starts) & (neighbour < seg_ends)
+            sr_distances[is_valid] = np.minimum(
+                sr_distances[is_valid],
+                np.abs(sr_idxs[is_valid] - flat_starts[neighbour[is_valid]]),
+            )
+        distances.append(pl.Series(sr_distances).set(pl.Series(~has_starts), None))
+    return distances
+
+
+def _get_window_means(values, value_starts, value_lens, starts, lengths):
+    """ Helper function to get the mean of each row's values[start:start+length], NaN for
+        empty windows.
+    """
+    lengths = _slice_lengths(starts, lengths, value_lens)
+    starts = value_starts + np.minimum(starts, value_lens)
+    means = np.full(len(starts), np.nan, dtype=np.float64)
+    for length in np.unique(lengths[lengths > 0]):
+        is_length = lengths == length
+        means[is_length] = values[starts[is_length, None] + np.arange(length)].mean(axis=1)
+    return means
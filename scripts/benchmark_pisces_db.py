@@ -0,0 +1,94 @@
+""" Benchmark of the list column conversion at the end of the createPiscesDB pipeline,
+    comparing the per row Python conversion against the native Polars expressions.
+"""
+from time import perf_counter
+
+import numpy as np
+import polars as pl
+
+from ppm.create_pisces_db import COLUMNS, COUNT_COLUMNS, INT_COLS, split_list_columns
+
+N_PEPTIDES = [10_000, 100_000, 1_000_000]
+AMINO_ACIDS = 'ACDEFGHKLMNPQRSTVWY'
+
+
+def create_synthetic_df(n_peptides):
+    """ Function to create a combined DataFrame with space separated string columns.
+    """
+    rng = np.random.default_rng(42)
+    codes = rng.integers(0, len(AMINO_ACIDS), size=(n_peptides, 9), dtype=np.uint8)
+    peptides = np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)[codes]
+    data = {
+        'peptide': peptides.view('S9').ravel().astype(str),
+        'stratum': rng.choice(['canonical', 'spliced', 'cryptic'], n_peptides),
+        'maxProbability': rng.random(n_peptides),
+    }
+    n_entries = rng.integers(0, 4, n_peptides)
+    for column in COLUMNS:
+        if 'nProteins' in column or column in ['nCrypticProteins', 'nSplicedProteins']:
+            data[column] = n_entries
+        elif column in INT_COLS:
+            data[column] = [' '.join(['12'] * n_entry) for n_entry in n_entries]
+        else:
+            data[column] = [' '.join(['ENSP00000000001.1'] * n_entry) for n_entry in n_entries]
+    return pl.DataFrame(data)
+
+
+def convert_map_elements(combined_df):
+    """ Previous row by row conversion of the list columns.
+    """
+    for column in COLUMNS:
+        if not 'nProteins' in column and column not in ['nCrypticProteins', 'nSplicedProteins']:
+            if column in INT_COLS:
+                combined_df = combined_df.with_columns(
+                    pl.col(column).map_elements(
+                        lambda x : [] if (not x or x is None) else [int(a) for a in x.split(' ')],
+                        return_dtype=pl.List(pl.Int64)
+                    )
+                )
+            else:
+                combined_df = combined_df.with_columns(
+                    pl.col(column).map_elements(
+                        lambda x : [] if (not x or x is None) else [y for y in x.split(' ') if y and y is not None],
+                        return_dtype=pl.List(pl.String)
+                    )
+                )
+            combined_df = combined_df.with_columns(pl.col(column).fill_null([]))
+    return combined_df
+
+
+def convert_native(combined_df):
+    """ Conversion of the list columns via native Polars expressions.
+    """
+    return combined_df.with_columns(split_list_columns())
+
+
+def finalise(combined_df):
+    """ Recount proteins and sort as in create_pisces_db.
+    """
+    combined_df = combined_df.with_columns(
+        pl.col(list_column).list.len().alias(count_column)
+        for count_column, list_column in COUNT_COLUMNS.items()
+    )
+    return combined_df.sort(by=['stratum', 'maxProbability'], descending=[False, True])
+
+
+def main():
+    print('nPeptides\tmapElements (s)\tnative (s)\tspeed up')
+    for n_peptides in N_PEPTIDES:
+        combined_df = create_synthetic_df(n_peptides)
+
+        start_time = perf_counter()
+        legacy_df = finalise(convert_map_elements(combined_df))
+        legacy_time = perf_counter() - start_time
+
+        start_time = perf_counter()
+        native_df = finalise(convert_native(combined_df))
+        native_time = perf_counter() - start_time
+
+        assert legacy_df.sort('peptide').equals(native_df.sort('peptide'))
+        print(f'{n_peptides}\t{legacy_time:.2f}\t{native_time:.2f}\t{legacy_time/native_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()